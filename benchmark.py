@@ -0,0 +1,296 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from common import PREVIEW_SIZE, STABILIZATION_EYES, ALIGN_SIMILARITY, DEFAULT_WORKERS
+from encoder import write_video
+from engine import EyeDetector, Timelapse
+from player import FrameSource
+from thumbnails import ThumbnailCache
+from timing import StageTimer
+
+# Run in a fresh interpreter: import the GUI, then build and show its window if there is a display
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import main
+result = {"import_seconds": time.perf_counter() - started}
+try:
+    app = main.TimelapseApp()
+    app.update()
+    result["window_seconds"] = time.perf_counter() - started
+    app.destroy()
+except Exception as error:
+    result["window_error"] = str(error)
+result["heavy_modules"] = [name for name in ("cv2", "numpy", "PIL") if name in sys.modules]
+print(json.dumps(result))
+"""
+
+
+def draw_face(img, center, size, angle):
+    """ Draw a face-like pattern the Haar cascades detect, returning the midpoint between its eyes
+
+    `size` is about half the width of the face, `angle` tilts it in degrees.
+    """
+    cos, sin = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+
+    def point(x, y):
+        return (int(center[0] + size * (x * cos - y * sin)), int(center[1] + size * (x * sin + y * cos)))
+
+    def ellipse(x, y, width, height, color):
+        axes = (max(1, int(width * size)), max(1, int(height * size)))
+        cv2.ellipse(img, point(x, y), axes, angle, 0, 360, color, -1, cv2.LINE_AA)
+
+    ellipse(0, -0.1, 0.95, 0.95, (40, 40, 50))  # Hair
+    ellipse(0, 0.15, 0.75, 1.0, (150, 175, 215))  # Skin
+    for side in (-1, 1):
+        ellipse(side * 0.33, -0.08, 0.24, 0.16, (110, 130, 170))  # Eye socket
+        ellipse(side * 0.33, -0.3, 0.22, 0.05, (40, 40, 50))  # Brow
+        ellipse(side * 0.33, -0.06, 0.18, 0.1, (225, 225, 225))  # Eyeball
+        ellipse(side * 0.33, -0.06, 0.095, 0.095, (40, 30, 20))  # Iris
+        ellipse(side * 0.33, -0.15, 0.19, 0.03, (60, 60, 80))  # Lid
+    ellipse(0, 0.3, 0.08, 0.16, (120, 145, 185))  # Nose
+    ellipse(0, 0.62, 0.28, 0.07, (70, 70, 150))  # Mouth
+    return point(0, -0.06)
+
+
+def make_sequence(directory, count, size=(1920, 1080), seed=0):
+    """ Write `count` JPEGs of a drawn face at jittered positions, scales, tilts and exposures
+
+    Returns the file paths and the true eye midpoints. A set generated with the same settings
+    before is reused.
+    """
+    settings = {"count": count, "size": list(size), "seed": seed}
+    manifest_path = os.path.join(directory, "sequence.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["settings"] == settings:
+            return [os.path.join(directory, name) for name in manifest["files"]], manifest["eye_midpoints"]
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = size
+    # A textured background and grain, drawn once and shifted for every frame
+    background = cv2.resize(rng.integers(70, 130, (9, 16, 3), dtype=np.uint8), size, interpolation=cv2.INTER_CUBIC)
+    grain = rng.normal(0, 6, (height, width, 1)).astype(np.float32)
+
+    files, eye_midpoints = [], []
+    for i in range(count):
+        img = background.copy()
+        face_size = min(width, height) * 0.2 * rng.uniform(0.9, 1.1)
+        center = (width / 2 + rng.uniform(-0.08, 0.08) * width, height / 2 + rng.uniform(-0.08, 0.08) * height)
+        eye_midpoint = draw_face(img, center, face_size, rng.uniform(-6, 6))
+        img = cv2.GaussianBlur(img, (0, 0), face_size * 0.012)
+        exposure = rng.uniform(0.85, 1.15)  # Flicker for the deflicker stage
+        shift = tuple(int(v) for v in rng.integers(0, 64, 2))
+        img = np.clip(img * np.float32(exposure) + np.roll(grain, shift, axis=(0, 1)), 0, 255).astype(np.uint8)
+
+        name = f"frame_{i:05d}.jpg"
+        cv2.imwrite(os.path.join(directory, name), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        files.append(name)
+        eye_midpoints.append(eye_midpoint)
+
+    with open(manifest_path, "w") as f:
+        json.dump({"settings": settings, "files": files, "eye_midpoints": eye_midpoints}, f)
+    return [os.path.join(directory, name) for name in files], eye_midpoints
+
+
+def result(seconds, frames, **extra):
+    return dict({"seconds": seconds, "frames": frames, "ms_per_frame": 1000 * seconds / frames if frames else 0.0},
+                **extra)
+
+
+def bench_thumbnails(file_paths, cache_dir):
+    """ Generate the thumbnails of every file, then read them back from the cache """
+    cache = ThumbnailCache(cache_dir)
+    started = time.perf_counter()
+    for file_path in file_paths:
+        cache.get(file_path)
+    generated = time.perf_counter() - started
+    started = time.perf_counter()
+    for file_path in file_paths:
+        cache.get(file_path)
+    cached = time.perf_counter() - started
+    return result(generated, len(file_paths), cached_ms_per_frame=1000 * cached / len(file_paths))
+
+
+def bench_detection(timelapse, eye_midpoints):
+    """ Detect the eyes of every frame and compare them with where they were drawn """
+    started = time.perf_counter()
+    timelapse.analyze()
+    seconds = time.perf_counter() - started
+    # Frames whose eyes were missed keep the previous position and show up as large errors
+    errors = [np.hypot(info.eye_midpoint[0] - x, info.eye_midpoint[1] - y)
+              for info, (x, y) in zip(timelapse.infos, eye_midpoints)]
+    return result(seconds, len(timelapse), stages=timelapse.timer.summary(), mean_error_px=float(np.mean(errors)),
+                  p95_error_px=float(np.percentile(errors, 95)))
+
+
+def bench_alignment(timelapse):
+    """ Decode, align and crop every frame at the output size without writing it """
+    started = time.perf_counter()
+    frames = timelapse.frames()
+    try:
+        count = sum(1 for _ in frames)
+    finally:
+        frames.close()
+    return result(time.perf_counter() - started, count, stages=timelapse.timer.summary())
+
+
+def bench_preview(timelapse):
+    """ Prepare every frame as the preview player does, at display size """
+    source = FrameSource(timelapse, PREVIEW_SIZE)
+    started = time.perf_counter()
+    for i in range(len(source)):
+        source.get(i)
+    return result(time.perf_counter() - started, len(source), stages=timelapse.timer.summary())
+
+
+def bench_encoding(timelapse, output_path):
+    """ Render and encode the time-lapse into an MP4 """
+    if shutil.which("ffmpeg") is None:
+        return {"skipped": "ffmpeg not found"}
+    stats = write_video(timelapse, output_path, display_time=1 / 24)
+    return result(stats["seconds"], stats["frames"], fps=stats["fps"], stages=timelapse.timer.summary())
+
+
+def bench_startup(runs):
+    """ Start the GUI in fresh interpreters, the first run also pays for a cold file cache """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=directory, capture_output=True, text=True)
+        if process.returncode != 0:
+            # Typically the GUI dependencies are missing, report it instead of failing the whole benchmark
+            lines = process.stderr.strip().splitlines()
+            return {"runs": runs, "startup_error": lines[-1] if lines else f"exit code {process.returncode}"}
+        sample = json.loads(process.stdout.strip().splitlines()[-1])
+        sample["process_seconds"] = time.perf_counter() - started
+        samples.append(sample)
+
+    summary = {"runs": runs, "first": samples[0], "heavy_modules": samples[-1]["heavy_modules"]}
+    for key in ("import_seconds", "window_seconds", "process_seconds"):
+        values = [sample[key] for sample in samples if key in sample]
+        if values:
+            summary[key] = {"min": min(values), "median": statistics.median(values)}
+    if "window_error" in samples[-1]:
+        summary["window_error"] = samples[-1]["window_error"]  # Typically no display
+    return summary
+
+
+def environment():
+    return {"python": platform.python_version(), "platform": platform.platform(), "opencv": cv2.__version__,
+            "numpy": np.__version__, "cpus": os.cpu_count()}
+
+
+def run(args, directory):
+    file_paths, eye_midpoints = make_sequence(os.path.join(directory, "images"), args.count, tuple(args.size),
+                                              args.seed)
+    scratch = tempfile.mkdtemp(dir=directory)
+    results = {}
+    try:
+        results["thumbnails"] = bench_thumbnails(file_paths, os.path.join(scratch, "thumbnails"))
+
+        detector = EyeDetector(detect_size=args.detect_size)
+        timelapse = Timelapse(file_paths, STABILIZATION_EYES, detector=detector, workers=args.workers,
+                              cache_path=False, alignment=ALIGN_SIMILARITY,
+                              max_size=tuple(args.output_size) if args.output_size else None)
+        results["detection"] = bench_detection(timelapse, eye_midpoints)
+
+        # Every stage starts with its own timer, the analysis is shared
+        timelapse.timer = StageTimer()
+        results["alignment"] = bench_alignment(timelapse)
+        timelapse.timer = StageTimer()
+        results["preview"] = bench_preview(timelapse)
+        timelapse.timer = StageTimer()
+        results["encoding"] = bench_encoding(timelapse, os.path.join(scratch, "benchmark.mp4"))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.startup_runs:
+        results["startup"] = bench_startup(args.startup_runs)
+    return results
+
+
+def compare(results, baseline):
+    """ Print the change in time per frame against the results of an earlier run """
+    for name, stats in results.items():
+        before = baseline.get("results", {}).get(name, {})
+        if "ms_per_frame" in stats and before.get("ms_per_frame"):
+            print(f"{name:>10}: {before['ms_per_frame']:.1f} -> {stats['ms_per_frame']:.1f} ms per frame "
+                  f"({stats['ms_per_frame'] / before['ms_per_frame']:.2f}x)")
+    before = baseline.get("results", {}).get("startup", {}).get("process_seconds")
+    after = results.get("startup", {}).get("process_seconds")
+    if before and after:
+        print(f"{'startup':>10}: {before['median']:.2f} -> {after['median']:.2f} s "
+              f"({after['median'] / before['median']:.2f}x)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time the PyLaps stages on a synthetic face time-lapse")
+    parser.add_argument("-n", "--count", type=int, default=50, help="Number of images (default: 50)")
+    parser.add_argument("--size", type=int, nargs=2, default=(1920, 1080), metavar=("WIDTH", "HEIGHT"),
+                        help="Resolution of the images (default: 1920 1080)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the face positions (default: 0)")
+    parser.add_argument("--directory",
+                        help="Keep the images in this directory to reuse them in later runs (default: a temporary one)")
+    parser.add_argument("--output-size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"),
+                        help="Scale the aligned and encoded frames down to fit into this resolution")
+    parser.add_argument("-j", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"Number of processes used for detection (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--detect-size", type=int,
+                        help="Detect faces on a copy downscaled to this many pixels on the long side")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="Number of cold GUI starts to time, 0 to skip (default: 5)")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare the results with")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.directory:
+        results = run(args, args.directory)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run(args, directory)
+
+    report = {"settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+              "environment": environment(), "results": results}
+    for name, stats in results.items():
+        if "ms_per_frame" in stats:
+            print(f"{name:>10}: {stats['ms_per_frame']:.1f} ms per frame over {stats['frames']} frames")
+        elif "skipped" in stats:
+            print(f"{name:>10}: skipped, {stats['skipped']}")
+    if "startup_error" in results.get("startup", {}):
+        print(f"{'startup':>10}: failed, {results['startup']['startup_error']}")
+    elif "startup" in results:
+        startup = results["startup"]
+        window = f", window shown after {startup['window_seconds']['median']:.2f} s" if "window_seconds" in startup \
+            else f", no window: {startup.get('window_error')}"
+        print(f"{'startup':>10}: {startup['process_seconds']['median']:.2f} s per process, "
+              f"GUI imported in {startup['import_seconds']['median']:.2f} s{window}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import argparse
+import os
+import sys
+
+from common import (STABILIZATION_NONE, STABILIZATION_EYES, STABILIZATION_HORIZON, ALIGN_TRANSLATION, ALIGN_SIMILARITY,
+                    DEFAULT_WINDOW, DEFAULT_WORKERS, DEFAULT_DUPLICATE_DISTANCE, DEFAULT_BLUR_RATIO,
+                    DEFAULT_DEFLICKER_WINDOW)
+from culling import CullSettings
+from encoder import write_video
+from engine import EyeDetector, Timelapse, collect_images, compare_midpoints
+
+STABILIZATION_CHOICES = {
+    "none": STABILIZATION_NONE,
+    "eyes": STABILIZATION_EYES,
+    "horizon": STABILIZATION_HORIZON,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render a stabilized time-lapse without the GUI")
+    parser.add_argument("images", nargs="*", help="Image files or directories of images, in frame order")
+    parser.add_argument("-o", "--output", help="Directory to write the rendered frames to")
+    parser.add_argument("-v", "--video", help="MP4 file to encode the rendered frames into")
+    parser.add_argument("-t", "--display-time", type=float, default=1.0,
+                        help="Seconds each image is shown in the video (default: 1.0)")
+    parser.add_argument("-s", "--stabilization", choices=STABILIZATION_CHOICES,
+                        help="Stabilization mode (default: eyes, or the one saved in --project)")
+    parser.add_argument("-a", "--align", choices=[ALIGN_TRANSLATION, ALIGN_SIMILARITY],
+                        help="Shift frames only, or also rotate and scale them by the eye pair (default: translation, "
+                             "or the one saved in --project); "
+                             "horizon stabilization always levels the frames")
+    parser.add_argument("--size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"),
+                        help="Scale the frames down to fit into this resolution")
+    parser.add_argument("-w", "--window", type=int, default=DEFAULT_WINDOW,
+                        help=f"Maximum number of decoded frames in flight (default: {DEFAULT_WINDOW})")
+    parser.add_argument("-j", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"Number of processes used for detection (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--detect-size", type=int,
+                        help="Detect faces on a copy downscaled to this many pixels on the long side")
+    parser.add_argument("--track", action="store_true",
+                        help="Search for the face around its position in the previous frame first")
+    parser.add_argument("--compare-full", action="store_true",
+                        help="Also detect at full resolution without tracking and report the eye midpoint error")
+    parser.add_argument("--timings", help="Write the per-stage timings to this JSON file")
+    parser.add_argument("--cache", help="Detection cache file (default: .pylaps/detections.sqlite next to the images)")
+    parser.add_argument("--no-cache", action="store_true", help="Detect every image again instead of using the cache")
+    parser.add_argument("--dedupe", type=int, nargs="?", const=DEFAULT_DUPLICATE_DISTANCE, metavar="BITS",
+                        help="Skip near-duplicates of the previous frames whose perceptual hashes differ by at most "
+                             f"this many bits, keeping the sharpest (default: {DEFAULT_DUPLICATE_DISTANCE})")
+    parser.add_argument("--drop-blurry", type=float, nargs="?", const=DEFAULT_BLUR_RATIO, metavar="RATIO",
+                        help="Skip frames less than this fraction as sharp as their neighbours "
+                             f"(default: {DEFAULT_BLUR_RATIO})")
+    parser.add_argument("--flag-only", action="store_true",
+                        help="Only report near-duplicate and blurry frames instead of skipping them")
+    parser.add_argument("--deflicker", type=int, nargs="?", const=DEFAULT_DEFLICKER_WINDOW, metavar="FRAMES",
+                        help="Even out the brightness of every frame to the rolling average over this many frames "
+                             f"(default: {DEFAULT_DEFLICKER_WINDOW})")
+    parser.add_argument("--project",
+                        help="Project file to append the images to, only new images are analyzed and written")
+    args = parser.parse_args(argv)
+    if not args.images and not args.project:
+        parser.error("images are required without --project")
+    if not args.output and not args.video:
+        parser.error("one of --output or --video is required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        return run(args)
+    except (OSError, ValueError) as error:  # E.g. an unreadable or half-written image, or a broken project file
+        print(error, file=sys.stderr)
+        return 1
+
+
+def run(args):
+    """ Analyze and render the time-lapse described by the parsed arguments, returning the exit code """
+    file_paths = collect_images(args.images)
+    detector = EyeDetector(detect_size=args.detect_size, track=args.track)
+    options = {"window": args.window, "detector": detector, "workers": args.workers,
+               "cache_path": False if args.no_cache else args.cache, "max_size": args.size,
+               "deflicker": args.deflicker}
+    if args.dedupe is not None or args.drop_blurry is not None:
+        options["culling"] = CullSettings(args.dedupe, args.drop_blurry, drop=not args.flag_only)
+    if args.project and os.path.exists(args.project):
+        # Continue the project with its own modes unless others are given, its analysis is kept if they match
+        stabilization = STABILIZATION_CHOICES[args.stabilization] if args.stabilization else None
+        timelapse = Timelapse.load(args.project, stabilization, args.align, **options)
+        added = timelapse.add_files(file_paths)
+        print(f"Added {len(added)} of {len(file_paths)} images to {len(timelapse) - len(added)} in {args.project}")
+    else:
+        timelapse = Timelapse(file_paths, STABILIZATION_CHOICES[args.stabilization or "eyes"],
+                              alignment=args.align or ALIGN_TRANSLATION, **options)
+    if not len(timelapse):
+        print("No images found.", file=sys.stderr)
+        return 1
+
+    culled = len(timelapse.culled)
+    timelapse.analyze()
+    if timelapse.culled[culled:]:
+        names = [os.path.basename(path) for path in timelapse.culled[culled:]]
+        listed = ", ".join(names[:10]) + (f" and {len(names) - 10} more" if len(names) > 10 else "")
+        print(f"{'Flagged' if args.flag_only else 'Skipped'} {len(names)} near-duplicate or blurry images: {listed}")
+    if args.project:
+        timelapse.save(args.project)
+
+    if args.compare_full:
+        # The reference detector has its own cache entries, they are shared with the GUI's defaults
+        reference = Timelapse(timelapse.file_paths, STABILIZATION_EYES, workers=args.workers,
+                              cache_path=options["cache_path"])
+        report = compare_midpoints(reference.analyze().infos, timelapse.infos)
+        print(f"Eye midpoint error vs. full resolution over {report['frames']} frames: "
+              f"mean {report['mean']:.1f}px, p95 {report['p95']:.1f}px, max {report['max']:.1f}px")
+
+    if args.output:
+        count = timelapse.write_frames(args.output)
+        print(f"Wrote {count} of {len(timelapse)} frames to {args.output}")
+        if args.project:
+            timelapse.save(args.project)  # Remembers which frames are written
+
+    if args.video:
+        try:
+            stats = write_video(timelapse, args.video, args.display_time, queue_size=args.window)
+        except RuntimeError as error:  # FFmpeg is missing or failed
+            print(error, file=sys.stderr)
+            return 1
+        print(f"Encoded {stats['frames']} frames to {args.video} in {stats['seconds']:.1f}s ({stats['fps']:.1f} fps), "
+              f"blocked on encoder {stats['producer_wait']:.1f}s, on ffmpeg input {stats['encoder_wait']:.1f}s")
+
+    print(f"Stage timings: {timelapse.timer.format()}")
+    if args.timings:
+        timelapse.timer.dump(args.timings)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import os
+
+# Stabilization modes shared by the GUI and the headless engine
+STABILIZATION_NONE = "None"
+STABILIZATION_EYES = "Eye Tracking"
+STABILIZATION_HORIZON = "Horizon"
+STABILIZATION_OPTIONS = [STABILIZATION_NONE, STABILIZATION_EYES, STABILIZATION_HORIZON]
+
+# Eye alignment: shift only, or also rotate and scale to level the eyes at a common distance
+ALIGN_TRANSLATION = "translation"
+ALIGN_SIMILARITY = "similarity"
+
+# Directory created next to the images for PyLaps' sidecar files (caches, project state)
+SIDECAR_DIR = ".pylaps"
+
+
+def sidecar_path(file_paths, name):
+    """ Place a sidecar file or directory in the directory of the first image, next to the other caches """
+    return os.path.join(os.path.dirname(os.path.abspath(file_paths[0])), SIDECAR_DIR, name)
+
+
+# File extensions picked up when a directory is given instead of single images
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+# Size of the thumbnails in the image grid
+THUMBNAIL_SIZE = (100, 100)
+
+# Largest frame shown by the preview
+PREVIEW_SIZE = (600, 400)
+
+# Aligned frames needed before the preview starts while the rest are still processing
+PREVIEW_START_FRAMES = 8
+
+# Long side of the small gray decodes that frames are hashed and rated for sharpness on
+SIGNATURE_SIZE = 256
+
+# Culling defaults: bits two difference hashes may differ by to be near-duplicates, and how much less
+# sharp than its neighbours a frame may be before it counts as blurry
+DEFAULT_DUPLICATE_DISTANCE = 3
+DEFAULT_BLUR_RATIO = 0.5
+
+# Frames in the rolling luminance average that deflickering scales every frame onto
+DEFAULT_DEFLICKER_WINDOW = 15
+
+# Number of decoded frames allowed in flight between pipeline stages
+DEFAULT_WINDOW = 8
+
+# Number of processes used for face and eye detection
+DEFAULT_WORKERS = os.cpu_count() or 1
@@ -0,0 +1,151 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from common import SIGNATURE_SIZE
+from decoding import decode_small_gray
+
+# Which frames to cull before the expensive stages: frames within `max_distance` bits of the first
+# frame of their burst are near-duplicates, frames less than `blur_ratio` times as sharp as their
+# neighbours are blurry. None disables a check; with `drop` culled frames are removed from the set,
+# otherwise they are only flagged.
+CullSettings = namedtuple("CullSettings", ["max_distance", "blur_ratio", "drop"])
+
+# Number of frames around a frame whose median sharpness it is compared with
+BLUR_WINDOW = 9
+
+def signature(file_path, size=SIGNATURE_SIZE):
+    """ Return the 64-bit difference hash, the sharpness and the mean luminance of a file from a small gray decode
+
+    The sharpness is the variance of the Laplacian, it drops when edges are smeared by motion blur
+    or missed focus.
+    """
+    _, _, gray = decode_small_gray(file_path, size)
+
+    # dHash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour
+    tiny = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    hash_bits = np.packbits(tiny[:, 1:] > tiny[:, :-1])
+    return (int.from_bytes(hash_bits.tobytes(), "big"), float(cv2.Laplacian(gray, cv2.CV_32F).var()),
+            float(gray.mean()))
+
+
+def hamming(a, b):
+    """ Number of differing bits of two hashes """
+    return bin(int(a) ^ int(b)).count("1")
+
+
+class FrameIndex:
+    """ Array-backed index of frame signatures, keyed by absolute path, size and modification time
+
+    Hashes, sharpness and luminance are kept in NumPy arrays and saved as one .npz file, signatures
+    of files that did not change since are reused.
+    """
+    def __init__(self, paths=(), stats=None, hashes=None, sharpness=None, luminance=None):
+        self.paths = list(paths)
+        self.positions = {path: i for i, path in enumerate(self.paths)}
+        self.stats = np.zeros((0, 2), np.int64) if stats is None else stats  # (size, mtime_ns) per file
+        self.hashes = np.zeros(0, np.uint64) if hashes is None else hashes
+        self.sharpness = np.zeros(0, np.float32) if sharpness is None else sharpness
+        self.luminance = np.zeros(0, np.float32) if luminance is None else luminance
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if "luminance" not in data:
+                return cls()  # Written before luminance was indexed, every file is signed again
+            return cls(data["paths"].tolist(), data["stats"], data["hashes"], data["sharpness"], data["luminance"])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Write to a temporary file first, a concurrent reader never sees half an index
+        temp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(temp_path, paths=np.array(self.paths, dtype=str), stats=self.stats, hashes=self.hashes,
+                 sharpness=self.sharpness, luminance=self.luminance)
+        os.replace(temp_path, path)
+
+    def update(self, file_paths, workers=1, timer=None):
+        """ Compute the signatures of new or modified files, returning the positions of all files """
+        keys = [os.path.abspath(file_path) for file_path in file_paths]
+        stats = [(stat.st_size, stat.st_mtime_ns) for stat in map(os.stat, keys)]
+        stale = [(path, stat) for path, stat in zip(keys, stats)
+                 if path not in self.positions or tuple(self.stats[self.positions[path]]) != stat]
+
+        if stale:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                signatures = list(executor.map(signature, [path for path, _ in stale]))
+            if timer is not None:
+                timer.add("signature", time.perf_counter() - started, len(stale))
+
+            # Grow the arrays once for all new files, modified files are updated in place
+            new = [path for path, _ in stale if path not in self.positions]
+            for path in new:
+                self.positions[path] = len(self.paths)
+                self.paths.append(path)
+            self.stats = np.concatenate([self.stats, np.zeros((len(new), 2), np.int64)])
+            self.hashes = np.concatenate([self.hashes, np.zeros(len(new), np.uint64)])
+            self.sharpness = np.concatenate([self.sharpness, np.zeros(len(new), np.float32)])
+            self.luminance = np.concatenate([self.luminance, np.zeros(len(new), np.float32)])
+            for (path, stat), (frame_hash, sharpness, luminance) in zip(stale, signatures):
+                i = self.positions[path]
+                self.stats[i], self.hashes[i] = stat, frame_hash
+                self.sharpness[i], self.luminance[i] = sharpness, luminance
+
+        return np.array([self.positions[path] for path in keys], np.int64)
+
+
+def near_duplicates(hashes, sharpness, max_distance, kept=0):
+    """ Mark all but the sharpest frame of every burst of near-duplicates
+
+    A burst starts at a frame and holds the consecutive frames within `max_distance` bits of it.
+    Comparing with the start instead of the previous frame keeps a slow drift from chaining a whole
+    time-lapse into one burst. The first `kept` frames were kept before and are never marked, a
+    burst continuing them marks all its other frames.
+    """
+    hashes = [int(frame_hash) for frame_hash in hashes]
+    duplicate = np.zeros(len(hashes), bool)
+    start = 0
+    for i in range(1, len(hashes) + 1):
+        if i < len(hashes) and hamming(hashes[start], hashes[i]) <= max_distance:
+            continue
+        if start < kept:
+            duplicate[kept:i] = True
+        else:
+            duplicate[start:i] = True
+            duplicate[start + int(np.argmax(sharpness[start:i]))] = False
+        start = i
+    return duplicate
+
+
+def blurry(sharpness, blur_ratio, window=BLUR_WINDOW):
+    """ Mark frames less than `blur_ratio` times as sharp as the median of the `window` frames around them
+
+    Sharpness depends on the scene, so frames are compared with their neighbours, not a fixed threshold.
+    """
+    if len(sharpness) == 0:
+        return np.zeros(0, bool)
+    padded = np.pad(np.asarray(sharpness, np.float32), window // 2, mode="edge")
+    medians = np.median(np.lib.stride_tricks.sliding_window_view(padded, window), axis=1)
+    return np.asarray(sharpness) < blur_ratio * medians
+
+
+def cull(file_paths, settings, index, kept=0, workers=1, timer=None):
+    """ Return a mask of the files that are near-duplicates or blurry according to `settings`
+
+    Signatures are taken from and added to `index`. The first `kept` files are frames kept before,
+    e.g. the end of a growing set; they are compared with but never culled.
+    """
+    positions = index.update(file_paths, workers, timer)
+    hashes, sharpness = index.hashes[positions], index.sharpness[positions]
+
+    culled = np.zeros(len(file_paths), bool)
+    if settings.max_distance is not None:
+        culled |= near_duplicates(hashes, sharpness, settings.max_distance, kept)
+    if settings.blur_ratio is not None:
+        culled |= blurry(sharpness, settings.blur_ratio)
+    culled[:kept] = False
+    return culled
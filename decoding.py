@@ -0,0 +1,44 @@
+import cv2
+from PIL import Image
+
+# imread flags that decode JPEGs at 1/2, 1/4 and 1/8 scale straight from the DCT coefficients
+REDUCED_READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                      8: cv2.IMREAD_REDUCED_COLOR_8}
+REDUCED_GRAY_READ_FLAGS = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                           4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def decode(file_path, reduction=1, gray=False):
+    """ Decode an image file into a BGR (or gray) array, `reduction` times smaller on each side (1, 2, 4 or 8) """
+    img = cv2.imread(file_path, (REDUCED_GRAY_READ_FLAGS if gray else REDUCED_READ_FLAGS)[reduction])
+    if img is None:
+        raise ValueError(f"Could not decode image: {file_path}")
+    return img
+
+
+def decode_reduction(scale):
+    """ Return the largest decode reduction that keeps at least `scale` times the full resolution """
+    for reduction in (8, 4, 2):
+        if scale * reduction <= 1.0:
+            return reduction
+    return 1
+
+
+def image_shape(file_path):
+    """ Return the (height, width) decode() produces at full resolution, reading only the header """
+    with Image.open(file_path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):  # EXIF orientation, imread rotates by 90 degrees
+            width, height = height, width
+    return height, width
+
+
+def decode_small_gray(file_path, size):
+    """ Decode a file as a gray array whose long side is at most `size`, returning (full shape, scale, array) """
+    shape = image_shape(file_path)
+    scale = min(1.0, size / max(shape))
+    gray = decode(file_path, decode_reduction(scale), gray=True)
+    target = (max(1, round(shape[1] * scale)), max(1, round(shape[0] * scale)))
+    if (gray.shape[1], gray.shape[0]) != target:
+        gray = cv2.resize(gray, target, interpolation=cv2.INTER_AREA)
+    return shape, target[0] / shape[1], gray
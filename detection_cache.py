@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+# Default upper bound for the stored detection records
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def detector_fingerprint(detector):
+    """ Hash the cascade files and detector parameters, entries of another detector are not used """
+    digest = hashlib.sha1()
+    for cascade_file in detector.cascade_files:
+        with open(cascade_file, "rb") as f:
+            digest.update(f.read())
+    digest.update(json.dumps(detector.params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class DetectionCache:
+    """ Persistent SQLite cache of per-image detection results
+
+    Entries are keyed by absolute file path and detector fingerprint and validated against the file's
+    size and modification time, so only new or modified files have to be detected again. Detectors with
+    other parameters keep their own entries side by side; least recently used entries are evicted once
+    the stored records exceed `max_bytes`.
+    """
+    def __init__(self, path, detector, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(detections)")]
+        if columns and "fingerprint" not in columns:
+            # Written when the whole cache belonged to one detector, which one is not known per entry
+            self.connection.execute("DROP TABLE detections")
+            self.connection.execute("DROP TABLE IF EXISTS meta")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS detections (path TEXT, fingerprint TEXT, size INTEGER, mtime_ns INTEGER, "
+            "data TEXT, nbytes INTEGER, accessed REAL, PRIMARY KEY (path, fingerprint))")
+        self.connection.commit()
+        self.fingerprint = detector_fingerprint(detector)
+
+    def get_many(self, file_paths):
+        """ Return {path: (shape, (faces, eyes, eye_midpoint))} for all paths with a valid entry """
+        found, keys = {}, []
+        for file_path in set(file_paths):
+            key = os.path.abspath(file_path)  # The same image given relative to another directory
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, data FROM detections WHERE path = ? AND fingerprint = ?",
+                (key, self.fingerprint)).fetchone()
+            if row is None:
+                continue
+
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (row[0], row[1]):
+                continue  # Modified since it was detected
+
+            data = json.loads(row[2])
+            eye_midpoint = tuple(data["eye_midpoint"]) if data["eye_midpoint"] is not None else None
+            detection = ([tuple(box) for box in data["faces"]], [tuple(box) for box in data["eyes"]], eye_midpoint)
+            found[file_path] = (tuple(data["shape"]), detection)
+            keys.append(key)
+
+        # Refresh the access time of the hits for LRU eviction
+        now = time.time()
+        self.connection.executemany("UPDATE detections SET accessed = ? WHERE path = ? AND fingerprint = ?",
+                                    [(now, key, self.fingerprint) for key in keys])
+        return found
+
+    def put(self, file_path, shape, detection):
+        """ Store the detection result of a file, keyed by the detector and the file's size and modification time """
+        faces, eyes, eye_midpoint = detection
+        stat = os.stat(file_path)
+        data = json.dumps({"shape": list(shape), "faces": faces, "eyes": eyes, "eye_midpoint": eye_midpoint},
+                          separators=(",", ":"))
+        self.connection.execute("INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (os.path.abspath(file_path), self.fingerprint, stat.st_size, stat.st_mtime_ns, data,
+                                 len(data), time.time()))
+
+    def evict(self):
+        """ Delete least recently used entries until the stored records fit into max_bytes
+
+        Entries of detectors that are no longer used are never accessed again and go first.
+        """
+        total = self.connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM detections").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        removed = 0
+        rows = self.connection.execute("SELECT rowid, nbytes FROM detections ORDER BY accessed").fetchall()
+        stale = []
+        for rowid, nbytes in rows:
+            if total - removed <= self.max_bytes:
+                break
+            stale.append((rowid,))
+            removed += nbytes
+        self.connection.executemany("DELETE FROM detections WHERE rowid = ?", stale)
+
+    def invalidate(self):
+        """ Forget all cached detections """
+        self.connection.execute("DELETE FROM detections")
+        self.connection.commit()
+
+    def commit(self):
+        self.evict()
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
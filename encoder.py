@@ -0,0 +1,176 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+from fractions import Fraction
+from itertools import chain
+
+import cv2
+
+from common import DEFAULT_WINDOW
+from timing import StageTimer
+
+
+class FFmpegEncoder:
+    """ Stream raw BGR frames into an ffmpeg subprocess that encodes an H.264 MP4
+
+    Every frame is written once; its display time is expressed through the input frame rate, so
+    ffmpeg timestamps each frame `display_time` seconds apart instead of receiving duplicates.
+    Frames pass through a bounded queue to a writer thread, so producing the next frames overlaps
+    with encoding. Time spent blocked on either side of the queue is recorded as back-pressure.
+    ffmpeg writes to a temporary file next to `output_path` that replaces it only once encoding
+    succeeded, so a failed or cancelled export leaves an existing video untouched.
+    """
+    def __init__(self, output_path, size, display_time=1.0, queue_size=DEFAULT_WINDOW, ffmpeg="ffmpeg",
+                 crf=20, preset="medium", timer=None):
+        self.output_path = output_path
+        self.temp_path = f"{output_path}.{os.getpid()}.tmp.mp4"
+        self.size = size
+        self.display_time = display_time
+        self.ffmpeg = ffmpeg
+        self.crf = crf
+        self.preset = preset
+        self.timer = timer or StageTimer()
+
+        self.frames = queue.Queue(maxsize=max(1, queue_size))
+        self.process = None
+        self.thread = None
+        self.error = None
+
+        # Throughput and back-pressure statistics
+        self.frame_count = 0
+        self.producer_wait = 0.0  # Time write() was blocked because the queue was full
+        self.encoder_wait = 0.0  # Time the writer thread was blocked by ffmpeg's stdin
+        self.started = None
+        self.finished = None
+
+    def command(self):
+        """ Build the ffmpeg command line """
+        width, height = self.size
+        rate = Fraction(1) / Fraction(self.display_time).limit_denominator(1000)
+        command = [self.ffmpeg, "-y", "-loglevel", "error", "-nostats",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-framerate", str(rate),
+                   "-i", "-"]
+        if width % 2 or height % 2:
+            # yuv420p needs even dimensions, drop the odd row/column instead of resampling
+            command += ["-vf", "crop=trunc(iw/2)*2:trunc(ih/2)*2"]
+        command += ["-c:v", "libx264", "-preset", self.preset, "-crf", str(self.crf), "-pix_fmt", "yuv420p",
+                    "-movflags", "+faststart", self.temp_path]
+        return command
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError(f"Could not run '{self.ffmpeg}', is FFmpeg installed?")
+
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self._write_frames, daemon=True)
+        self.thread.start()
+        return self
+
+    def _write_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue  # Drain the queue so write() does not block forever
+            try:
+                start = time.perf_counter()
+                self.process.stdin.write(memoryview(frame).cast("B"))
+                elapsed = time.perf_counter() - start
+                self.encoder_wait += elapsed
+                self.timer.add("encode", elapsed)
+            except (BrokenPipeError, OSError) as error:
+                self.error = error
+
+    def write(self, frame):
+        """ Queue a contiguous BGR frame of `size`, blocking while the queue is full """
+        if self.error is not None:
+            raise RuntimeError(f"FFmpeg stopped accepting frames: {self._stderr()}")
+        start = time.perf_counter()
+        self.frames.put(frame)
+        self.producer_wait += time.perf_counter() - start
+        self.frame_count += 1
+
+    def close(self):
+        """ Flush the queue, wait for ffmpeg to finish the file and return the statistics """
+        self.frames.put(None)
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        returncode = self.process.wait()
+        self.finished = time.perf_counter()
+
+        if returncode != 0 or self.error is not None:
+            self._remove_temp()
+            raise RuntimeError(f"FFmpeg failed with exit code {returncode}: {self._stderr()}")
+        os.replace(self.temp_path, self.output_path)
+        return self.stats()
+
+    def _remove_temp(self):
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+    def _stderr(self):
+        if self.process.poll() is None:
+            return "still running"
+        return self.process.stderr.read().decode(errors="replace").strip()
+
+    def stats(self):
+        """ Frames encoded per second of wall-clock time and the time spent blocked on either side """
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        return {
+            "frames": self.frame_count,
+            "seconds": elapsed,
+            "fps": self.frame_count / elapsed if elapsed > 0 else 0.0,
+            "producer_wait": self.producer_wait,
+            "encoder_wait": self.encoder_wait,
+        }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not leave a half-written file being encoded in the background
+            self.process.kill()
+            self.frames.put(None)
+            self.thread.join()
+            self.process.wait()
+            self._remove_temp()
+
+
+def write_video(timelapse, output_path, display_time=1.0, queue_size=DEFAULT_WINDOW, progress=None, **options):
+    """ Encode an analyzed time-lapse as an MP4, returning the encoder statistics
+
+    `progress(done, total)` is called after every queued frame and may raise to stop the export.
+    """
+    # Frames in the queue, the one being piped into ffmpeg and the one waiting to be queued
+    frames = timelapse.frames(held=queue_size + 2)
+
+    # The output size is only known from the first frame
+    first = next(frames, None)
+    if first is None:
+        raise ValueError("The time-lapse has no frames to encode")
+
+    size = (first.shape[1], first.shape[0])
+    try:
+        with FFmpegEncoder(output_path, size, display_time, queue_size, timer=timelapse.timer, **options) as encoder:
+            for frame in chain([first], frames):
+                if frame.shape != first.shape:
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)  # Unaligned sets may mix sizes
+                encoder.write(frame)
+                if progress is not None:
+                    progress(encoder.frame_count, len(timelapse))
+    finally:
+        frames.close()
+    return encoder.stats()
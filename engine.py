@@ -0,0 +1,888 @@
+import json
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import cv2  # OpenCV for decoding, face and eye detection
+import numpy as np
+
+from common import (STABILIZATION_EYES, STABILIZATION_HORIZON, ALIGN_TRANSLATION, ALIGN_SIMILARITY, IMAGE_EXTENSIONS,
+                    DEFAULT_WINDOW, DEFAULT_WORKERS, sidecar_path)
+from culling import BLUR_WINDOW, FrameIndex, cull
+from decoding import decode, decode_reduction, decode_small_gray, image_shape
+from detection_cache import DetectionCache
+from horizon import HorizonDetector
+from timing import StageTimer
+
+# Raw detector output: face boxes, the eye boxes that were used and their midpoint (or None)
+Detection = namedtuple("Detection", ["faces", "eyes", "eye_midpoint"])
+
+# Per-frame analysis result, small enough to keep for every image of a large set.
+# eye_angle (degrees) and eye_distance describe the line between the eye centres.
+FrameInfo = namedtuple("FrameInfo", ["path", "shape", "eye_midpoint", "eye_angle", "eye_distance"])
+
+# Minimal distances from the eye midpoint to each edge of the aligned frames over the whole set.
+# eye_distance is the distance all frames are scaled to, None for translation-only alignment.
+CropBox = namedtuple("CropBox", ["left", "right", "top", "bottom", "eye_distance"])
+
+
+class EyeDetector:
+    """ Find the midpoint between the eyes of the first face with two visible eyes
+
+    With `detect_size` set, detection runs on a copy of the frame whose long side is at most that
+    many pixels and the results are mapped back to full resolution. With `track` set, the face is
+    first searched only around the face box of the previous frame, falling back to a full search
+    when it is lost there.
+    """
+    def __init__(self, scale_factor=1.3, min_neighbors=5, detect_size=None, track=False, track_margin=0.5):
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.detect_size = detect_size
+        self.track = track
+        self.track_margin = track_margin  # Fraction of the face size searched around the previous face
+
+        # The OpenCV face and eye classifiers, loaded by the first detection
+        self.cascade_files = [cv2.data.haarcascades + 'haarcascade_frontalface_default.xml',
+                              cv2.data.haarcascades + 'haarcascade_eye.xml']
+        self.cascades = None
+
+    @property
+    def params(self):
+        """ Keyword arguments that recreate an equivalent detector, e.g. in a worker process """
+        return {"scale_factor": self.scale_factor, "min_neighbors": self.min_neighbors,
+                "detect_size": self.detect_size, "track": self.track, "track_margin": self.track_margin}
+
+    def detect(self, gray, previous_face=None):
+        """ Return a Detection in image coordinates, its eye_midpoint is None if no eye pair was found """
+        # Detect on a reduced-resolution level of the image
+        height, width = gray.shape[:2]
+        scale = 1.0
+        if self.detect_size and max(height, width) > self.detect_size:
+            scale = self.detect_size / max(height, width)
+            gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+        detection = None
+        if self.track and previous_face is not None:
+            # Search only around the face of the previous frame, time-lapse subjects barely move
+            x, y, w, h = [v * scale for v in previous_face]
+            margin_x, margin_y = w * self.track_margin, h * self.track_margin
+            left, top = max(0, int(x - margin_x)), max(0, int(y - margin_y))
+            right, bottom = min(gray.shape[1], int(x + w + margin_x)), min(gray.shape[0], int(y + h + margin_y))
+            detection = self._detect(gray[top:bottom, left:right], left, top)
+            if not detection.faces:
+                detection = None  # Tracking lost, fall back to a full search
+
+        if detection is None:
+            detection = self._detect(gray, 0, 0)
+
+        if scale == 1.0:
+            return detection
+        return Detection([scale_box(face, 1 / scale) for face in detection.faces],
+                         [scale_box(eye, 1 / scale) for eye in detection.eyes],
+                         scale_box(detection.eye_midpoint, 1 / scale) if detection.eye_midpoint else None)
+
+    def _detect(self, gray, offset_x, offset_y):
+        """ Detect faces and eyes in `gray`, returning boxes shifted by the offset of that region """
+        if self.cascades is None:
+            self.cascades = [cv2.CascadeClassifier(cascade_file) for cascade_file in self.cascade_files]
+        face_cascade, eye_cascade = self.cascades
+        faces = face_cascade.detectMultiScale(gray, self.scale_factor, self.min_neighbors)
+        faces = [(offset_x + int(x), offset_y + int(y), int(w), int(h)) for (x, y, w, h) in faces]
+
+        for i, (x, y, w, h) in enumerate(faces):
+            roi_gray = gray[y-offset_y:y-offset_y+h, x-offset_x:x-offset_x+w]
+
+            # Detect eyes within the face region, we need at least two to align
+            eyes = eye_cascade.detectMultiScale(roi_gray)
+            if len(eyes) >= 2:
+                eye1, eye2 = [(x + int(ex), y + int(ey), int(ew), int(eh)) for (ex, ey, ew, eh) in eyes[:2]]
+                eye1_center = (eye1[0] + eye1[2] // 2, eye1[1] + eye1[3] // 2)
+                eye2_center = (eye2[0] + eye2[2] // 2, eye2[1] + eye2[3] // 2)
+                eye_midpoint = ((eye1_center[0] + eye2_center[0]) // 2, (eye1_center[1] + eye2_center[1]) // 2)
+
+                # The face the eyes belong to goes first, it is the one tracked into the next frame
+                return Detection([faces[i]] + faces[:i] + faces[i+1:], [eye1, eye2], eye_midpoint)
+
+        return Detection(faces, [], None)
+
+
+def eye_geometry(eyes):
+    """ Return the angle (degrees) and length of the line from the left to the right eye centre """
+    (x1, y1, w1, h1), (x2, y2, w2, h2) = sorted(eyes)
+    dx = (x2 + w2 / 2) - (x1 + w1 / 2)
+    dy = (y2 + h2 / 2) - (y1 + h1 / 2)
+    return math.degrees(math.atan2(dy, dx)), math.hypot(dx, dy)
+
+
+def scale_box(box, factor):
+    """ Scale a box or point given in pixels by `factor`, rounding to whole pixels """
+    return tuple(int(round(v * factor)) for v in box)
+
+
+def collect_images(paths):
+    """ Expand directories into their (sorted) image files, keep plain file paths as given """
+    file_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+            file_paths.extend(os.path.join(path, name) for name in names)
+        else:
+            file_paths.append(path)
+    return file_paths
+
+
+def relative_path(path, directory):
+    """ Return `path` relative to `directory`, or absolute if that is impossible (e.g. another drive) """
+    path = os.path.abspath(path)
+    prefix = os.path.join(directory, "")
+    if path.startswith(prefix):
+        return path[len(prefix):]  # The common case of images next to the project, relpath is slow
+    try:
+        return os.path.relpath(path, directory)
+    except ValueError:
+        return path
+
+
+def detect_sequence(file_paths, detector, timer=None):
+    """ Decode and detect files in order, yielding (path, shape, detection) per file
+
+    When the detector tracks, each frame is searched around the face found in the one before.
+    """
+    timer = timer or StageTimer()
+    previous_face = None
+    for file_path in file_paths:
+        with timer.stage("decode"):
+            img = decode(file_path)
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        with timer.stage("detect"):
+            detection = detector.detect(gray, previous_face)
+        previous_face = detection.faces[0] if detection.faces else None
+
+        yield file_path, img.shape[:2], detection
+
+
+# Detector of the current worker process, loaded once by _init_worker
+_worker_detector = None
+
+
+def _init_worker(params):
+    global _worker_detector
+    _worker_detector = EyeDetector(**params)
+
+
+def _detect_in_worker(file_paths):
+    timer = StageTimer()
+    return list(detect_sequence(file_paths, _worker_detector, timer)), timer.totals()
+
+
+def detect_files(file_paths, detector, workers=1, chunksize=4, timer=None):
+    """ Run detect_sequence over all files, in order, on `workers` processes
+
+    Every worker loads its own CascadeClassifier with the same parameters as `detector` and
+    processes runs of consecutive frames. Without tracking the results are identical to the serial
+    path; with tracking the first frame of every run is searched in full.
+    """
+    timer = timer or StageTimer()
+    if workers <= 1 or len(file_paths) <= 1:
+        yield from detect_sequence(file_paths, detector, timer)
+        return
+
+    if detector.track:
+        # Longer runs keep the tracker locked, four runs per worker still balance the load
+        chunksize = max(chunksize, -(-len(file_paths) // (workers * 4)))
+    chunks = iter([file_paths[i:i+chunksize] for i in range(0, len(file_paths), chunksize)])
+
+    # Spawned rather than forked, a fork would copy locks held by other threads (e.g. the GUI's decoders)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(detector.params,)) as executor:
+        # Keep two runs per worker in flight, so stopping early only waits for those
+        pending = deque(executor.submit(_detect_in_worker, chunk) for chunk in islice(chunks, workers * 2))
+        try:
+            while pending:
+                results, totals = pending.popleft().result()
+                pending.extend(executor.submit(_detect_in_worker, chunk) for chunk in islice(chunks, 1))
+                timer.merge(totals)
+                yield from results
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def analyze(file_paths, detector, workers=1, cache=None, timer=None, previous=None):
+    """ Detect the eye midpoint of every file, yielding a FrameInfo per file in order
+
+    Files found in `cache` are not decoded again, only new or modified files are detected.
+    Frames without a detectable eye pair reuse the last known eye position (or the image centre
+    before the first detection), time-lapse subjects barely move between frames. `previous` is
+    the FrameInfo of the frame before the first file, if frames are appended to a set.
+    """
+    cached = cache.get_many(file_paths) if cache is not None else {}
+    detected = detect_files([path for path in file_paths if path not in cached], detector, workers, timer=timer)
+
+    last_midpoint, last_geometry = None, (0.0, None)
+    if previous is not None:
+        last_midpoint, last_geometry = previous.eye_midpoint, (previous.eye_angle, previous.eye_distance)
+    for file_path in file_paths:
+        if file_path in cached:
+            shape, detection = cached[file_path]
+            detection = Detection(*detection)
+        else:
+            _, shape, detection = next(detected)
+            if cache is not None:
+                cache.put(file_path, shape, detection)
+
+        if detection.eye_midpoint is None:
+            eye_midpoint = last_midpoint or (shape[1] // 2, shape[0] // 2)
+            eye_angle, eye_distance = last_geometry
+        else:
+            eye_midpoint = detection.eye_midpoint
+            eye_angle, eye_distance = eye_geometry(detection.eyes)
+        last_midpoint, last_geometry = eye_midpoint, (eye_angle, eye_distance)
+
+        yield FrameInfo(file_path, shape, eye_midpoint, eye_angle, eye_distance)
+
+    if cache is not None:
+        cache.commit()
+
+
+def remove_outlier(values, i, size, tolerance):
+    """ Return values[i], or the median of its window if it is an outlier among its neighbours
+
+    A Hampel filter: a value further than three scaled median absolute deviations (and at least
+    `tolerance`) from the median of the `size` values around it is replaced by that median. Near
+    the ends the window is shifted inwards, the spread of fewer values would be unreliable.
+    """
+    start = max(0, min(i - size // 2, len(values) - size))
+    window = np.asarray(values[start:start + size])
+    median = np.median(window)
+    spread = 1.4826 * np.median(np.abs(window - median))
+    return float(median) if abs(values[i] - median) > max(3 * spread, tolerance) else float(values[i])
+
+
+def analyze_horizon(file_paths, detector, workers=1, batch_size=16, smoothing=9, timer=None, previous=None):
+    """ Estimate the horizon of every file, yielding a FrameInfo per file in order
+
+    Files are decoded as small gray images on `workers` threads and detected a batch at a time. The
+    horizon's height at the centre of the frame is used as the anchor point and its tilt as the angle,
+    with the frame width as reference length so frames are levelled without being scaled. Estimates
+    that stand out from the `smoothing` frames around them, e.g. a cloud edge that won the vote, are
+    replaced by the median of those frames while real movements of the camera are kept; a frame is
+    yielded once its window is complete. Frames without any edges reuse the previous estimate (or a
+    level line through the centre). `previous` is the FrameInfo of the frame before the first file,
+    if frames are appended to a set.
+    """
+    timer = timer or StageTimer()
+    smoothing = max(1, smoothing)
+    shapes, heights, angles = [], [], []
+    emitted = 0
+
+    def smoothed(i):
+        width = shapes[i][1]
+        # A few small-image pixels of height and a couple of angle steps are within the noise of the estimate
+        midpoint = (width / 2, remove_outlier(heights, i, smoothing, 4 * max(shapes[i]) / detector.size))
+        angle = remove_outlier(angles, i, smoothing, 2 * detector.angle_step)
+        return FrameInfo(file_paths[i], shapes[i], midpoint, angle, float(width))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for start in range(0, len(file_paths), batch_size):
+            # Timed per batch but counted per frame, like the stages of the other modes
+            started = time.perf_counter()
+            batch = list(executor.map(lambda path: decode_small_gray(path, detector.size),
+                                      file_paths[start:start + batch_size]))
+            timer.add("decode", time.perf_counter() - started, len(batch))
+
+            started = time.perf_counter()
+            horizons = detector.detect_batch([gray for _, _, gray in batch])
+            timer.add("detect", time.perf_counter() - started, len(batch))
+
+            for (shape, scale, _), horizon in zip(batch, horizons):
+                if horizon is None:
+                    if heights:
+                        height, angle = heights[-1], angles[-1]
+                    elif previous is not None:
+                        height, angle = previous.eye_midpoint[1], previous.eye_angle
+                    else:
+                        height, angle = shape[0] / 2, 0.0
+                else:
+                    # From the centre of the small pixel back to full-resolution coordinates
+                    height, angle = (horizon[0] + 0.5) / scale - 0.5, horizon[1]
+                shapes.append(shape)
+                heights.append(height)
+                angles.append(angle)
+
+            # Frames whose smoothing window is complete
+            while len(heights) >= max(emitted + smoothing // 2 + 1, smoothing):
+                yield smoothed(emitted)
+                emitted += 1
+
+    while emitted < len(heights):
+        yield smoothed(emitted)
+        emitted += 1
+
+
+def deflicker_gains(luminance, window):
+    """ Return per-frame gains that move the mean luminance of every frame onto its rolling average
+
+    Luminance is averaged over `window` frames in log space, which removes flicker but keeps slow
+    changes such as a sunset. At the ends the sequence is mirrored around the first and last frame,
+    so a trend continues there instead of flattening out.
+    """
+    log_luminance = np.log(np.maximum(np.asarray(luminance, np.float64), 1.0))
+    half = min(window // 2, len(log_luminance) - 1)
+    if half < 1:
+        return np.ones(len(log_luminance))
+    padded = np.pad(log_luminance, half, mode="reflect", reflect_type="odd")
+    smoothed = np.convolve(padded, np.full(2 * half + 1, 1.0 / (2 * half + 1)), mode="valid")
+    return np.exp(smoothed - log_luminance)
+
+
+def frame_transform(info, crop_box):
+    """ Return the (scale, angle) that bring the eyes of a frame to the common size and level them """
+    if crop_box.eye_distance is None or not info.eye_distance:
+        return 1.0, 0.0
+    return crop_box.eye_distance / info.eye_distance, info.eye_angle
+
+
+def compute_crop_box(infos, alignment=ALIGN_TRANSLATION):
+    """ Compute the minimal distances from the eye midpoint to each edge of the aligned frames
+
+    With similarity alignment every frame is scaled to the median eye distance and rotated to
+    level the eyes, the box is shrunk so that no rotated frame leaves empty corners.
+    """
+    eye_distance = None
+    if alignment == ALIGN_SIMILARITY:
+        distances = [info.eye_distance for info in infos if info.eye_distance]
+        eye_distance = float(np.median(distances)) if distances else None
+    crop_box = CropBox(0, 0, 0, 0, eye_distance)
+
+    # Distances to each edge, scaled but not yet rotated
+    edges = []
+    for info in infos:
+        img_height, img_width = info.shape
+        x, y = info.eye_midpoint
+        scale, angle = frame_transform(info, crop_box)
+        edges.append((scale * x, scale * (img_width - x), scale * y, scale * (img_height - y), angle))
+
+    left = min(edge[0] for edge in edges)
+    right = min(edge[1] for edge in edges)
+    top = min(edge[2] for edge in edges)
+    bottom = min(edge[3] for edge in edges)
+
+    if any(edge[4] for edge in edges):
+        # A rotated frame covers the box if each side, widened by the sine of the angle times the
+        # perpendicular extent, still fits. The unrotated extents bound the final ones from above.
+        width, height = max(left, right), max(top, bottom)
+        left = right = top = bottom = float('inf')
+        for left_edge, right_edge, top_edge, bottom_edge, angle in edges:
+            cos, sin = abs(math.cos(math.radians(angle))), abs(math.sin(math.radians(angle)))
+            left = min(left, (left_edge - height * sin) / cos)
+            right = min(right, (right_edge - height * sin) / cos)
+            top = min(top, (top_edge - width * sin) / cos)
+            bottom = min(bottom, (bottom_edge - width * sin) / cos)
+
+    return CropBox(*[max(0, int(v)) for v in (left, right, top, bottom)], eye_distance)
+
+
+def extend_crop_box(crop_box, infos, covered, alignment=ALIGN_TRANSLATION):
+    """ Return the crop box of `infos`, given `crop_box` of the first `covered` of them
+
+    With translation alignment the distances to the edges only shrink as frames are added, so only
+    the new frames are visited. With similarity alignment the frames are scaled to the median eye
+    distance of the whole set, which moves with every frame, and the box is computed again.
+    """
+    if crop_box is not None and covered == len(infos):
+        return crop_box
+    if crop_box is None or not covered or alignment != ALIGN_TRANSLATION:
+        return compute_crop_box(infos, alignment)
+    added = compute_crop_box(infos[covered:], alignment)
+    return CropBox(min(crop_box.left, added.left), min(crop_box.right, added.right), min(crop_box.top, added.top),
+                   min(crop_box.bottom, added.bottom), None)
+
+
+def fit_size(width, height, max_size=None):
+    """ Return the scale and (width, height) that fit a frame into max_size, keeping its aspect ratio """
+    scale = 1.0 if max_size is None else min(1.0, max_size[0] / width, max_size[1] / height)
+    return scale, (max(1, int(width * scale)), max(1, int(height * scale)))
+
+
+def alignment_matrix(info, crop_box, output_scale=1.0, reduction=1):
+    """ Compose eye alignment, crop and output scaling into one 2x3 affine matrix
+
+    Maps a source pixel p to output_scale * (R * scale * (p - eye_midpoint) + (crop_box.left, crop_box.top)),
+    where R rotates by minus the eye angle. For a source decoded `reduction` times smaller, its pixel q
+    is first mapped back to the full-resolution pixel p = reduction * q + (reduction - 1) / 2 it covers,
+    so eye midpoints and crop boxes stay in full-resolution coordinates.
+    """
+    scale, angle = frame_transform(info, crop_box)
+    factor = output_scale * scale
+    cos, sin = math.cos(math.radians(angle)) * factor, math.sin(math.radians(angle)) * factor
+    x, y = info.eye_midpoint
+    x, y = x - (reduction - 1) / 2, y - (reduction - 1) / 2
+    return np.float32([[cos * reduction, sin * reduction, output_scale * crop_box.left - (cos * x + sin * y)],
+                       [-sin * reduction, cos * reduction, output_scale * crop_box.top - (-sin * x + cos * y)]])
+
+
+def compare_midpoints(reference, candidate):
+    """ Compare the eye midpoints of two analyses of the same frames, distances in full-resolution pixels """
+    errors = np.array([np.hypot(a.eye_midpoint[0] - b.eye_midpoint[0], a.eye_midpoint[1] - b.eye_midpoint[1])
+                       for a, b in zip(reference, candidate)])
+    if len(errors) == 0:
+        return {"frames": 0, "mean": 0.0, "p95": 0.0, "max": 0.0}
+    return {"frames": len(errors), "mean": float(errors.mean()), "p95": float(np.percentile(errors, 95)),
+            "max": float(errors.max())}
+
+
+def render(frames, max_size=None, buffers=2, timer=None):
+    """ Decode and align one frame at a time, yielding BGR arrays that fit into max_size
+
+    `frames` yields (FrameInfo, CropBox or None, gain or None) triples, frames without a crop box are
+    only scaled. Each frame is decoded at the smallest JPEG scale (1/2, 1/4 or 1/8) that still covers
+    its output resolution. Aligned frames are produced by a single warp per frame straight into a ring
+    of `buffers` preallocated arrays, so a yielded frame is overwritten `buffers` frames later.
+    A deflicker gain is applied in place to the output-sized frame.
+    """
+    timer = timer or StageTimer()
+    ring, i = [], 0
+    for info, crop_box, gain in frames:
+        if crop_box is None:
+            if max_size is None:
+                scale, size = 1.0, None
+            else:
+                height, width = info.shape or image_shape(info.path)
+                scale, size = fit_size(width, height, max_size)
+            reduction = decode_reduction(scale)
+        else:
+            output_scale, size = fit_size(crop_box.left + crop_box.right, crop_box.top + crop_box.bottom, max_size)
+            reduction = decode_reduction(output_scale * frame_transform(info, crop_box)[0])
+
+        with timer.stage("decode"):
+            img = decode(info.path, reduction)
+
+        with timer.stage("align"):
+            if crop_box is None:
+                # Sized from the full resolution, a reduced decode may be a pixel larger than needed
+                frame = img if size is None or img.shape[:2] == (size[1], size[0]) else \
+                    cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            else:
+                if not ring or ring[0].shape[:2] != (size[1], size[0]):
+                    # Allocated once, again only if a provisional crop box changes the output size
+                    ring, i = [np.empty((size[1], size[0], 3), np.uint8) for _ in range(max(1, buffers))], 0
+                frame = ring[i % len(ring)]
+                i += 1
+                cv2.warpAffine(img, alignment_matrix(info, crop_box, output_scale, reduction), size, dst=frame,
+                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+        if gain is not None:
+            with timer.stage("deflicker"):
+                # A saturating multiply, the same as a gain lookup table with cv2.LUT but several times faster
+                cv2.convertScaleAbs(frame, dst=frame, alpha=gain)
+        yield frame
+
+
+class Prefetch:
+    """ Run an iterable in a background thread, keeping at most `window` items in flight
+
+    Lets decoding of the next frames overlap with whatever the consumer does while bounding
+    peak memory. Exceptions raised by the producer are re-raised in the consumer.
+    """
+    def __init__(self, iterable, window=DEFAULT_WINDOW):
+        self.iterable = iterable
+        self.items = queue.Queue(maxsize=max(1, window))
+        self.stop = threading.Event()
+        self.done = object()
+        self.finished = False
+
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            for item in self.iterable:
+                if not self._put((item, None)):
+                    return
+        except Exception as error:
+            self._put((self.done, error))
+        else:
+            self._put((self.done, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        item, error = self.items.get()
+        if item is self.done:
+            self.close()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self):
+        """ Unblock and stop the producer if the consumer exits early, waiting for it to finish
+
+        The producer checks `stop` at least every 0.1 s; joining it keeps a decode from still running
+        while the interpreter shuts down.
+        """
+        self.finished = True
+        self.stop.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+def write_frames(frames, output_dir, pattern="frame_{:05d}.png", start=0):
+    """ Encode frames as numbered image files, numbered from `start`, returning the number of frames written """
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    for i, frame in enumerate(frames, start):
+        cv2.imwrite(os.path.join(output_dir, pattern.format(i)), frame)
+        count += 1
+    return count
+
+
+# Version of the project file written by Timelapse.save
+PROJECT_VERSION = 1
+
+
+class Timelapse:
+    """ A re-iterable, streaming time-lapse of a growing image set
+
+    Analysis keeps one small FrameInfo per image; iterating decodes and aligns the frames again
+    so peak memory is bounded by `window` decoded frames instead of the size of the set.
+    Frames are scaled down to fit into `max_size`, if given.
+
+    Analysis may run on another thread: frames can be iterated while it is still running, they
+    follow the analyzed frames with a provisional crop box that is refined as analysis proceeds.
+    Files added later are analyzed on their own and the crop box is extended by them, the whole
+    state can be saved and loaded without analyzing anything again.
+    With `culling` settings, near-duplicate and blurry frames among the new files are dropped or
+    flagged in `culled` before the expensive analysis. With a `deflicker` window, the mean luminance
+    of every frame is measured on the same small decodes and the rendered frames are scaled onto its
+    rolling average.
+    Stage timings of analysis and rendering are collected in `timer`.
+    """
+    def __init__(self, file_paths, stabilization=STABILIZATION_EYES, window=DEFAULT_WINDOW, detector=None,
+                 workers=DEFAULT_WORKERS, cache_path=None, alignment=ALIGN_TRANSLATION, max_size=None,
+                 horizon_detector=None, culling=None, deflicker=None):
+        self.file_paths = list(file_paths)
+        self.stabilization = stabilization
+        self.alignment = alignment
+        self.max_size = max_size
+        self.window = window
+        self.workers = workers
+        # None stores detections next to the images, False disables the cache
+        self.cache_path = cache_path
+        if cache_path is None and self.file_paths:
+            self.cache_path = sidecar_path(self.file_paths, "detections.sqlite")
+        self.detector = detector
+        self.horizon_detector = horizon_detector
+        self.culling = culling
+        self.deflicker = deflicker  # Frames in the rolling luminance average, None disables deflickering
+        self.timer = StageTimer()
+
+        self.infos = []
+        self.crop_box = None
+        self.crop_box_frames = 0  # Number of frames the crop box covers
+        self.written = None  # Output directory, file names, crop box and size of the frames written so far
+        self.culled = []  # Files found to be near-duplicates or blurry, dropped from file_paths if culling.drop
+        self.luminance = []  # Mean luminance of the first files, measured for deflickering
+        self.gains = None  # Deflicker gain of every measured file
+        self.analyzing = False
+        self.condition = threading.Condition()  # Guards file_paths, infos, crop_box, luminance and analyzing
+
+    def _frame_index(self):
+        """ Open the index of frame signatures, kept next to the images unless caching is disabled """
+        index_path = sidecar_path(self.file_paths, "frame_index.npz") if self.cache_path else None
+        index = FrameIndex.load(index_path) if index_path and os.path.exists(index_path) else FrameIndex()
+        return index, index_path
+
+    def add_files(self, file_paths):
+        """ Append the files that are not part of the time-lapse yet and return them
+
+        The frames analyzed so far are kept, the next analyze() only analyzes the new files.
+        """
+        with self.condition:
+            known = {os.path.abspath(path) for path in self.file_paths}
+            if self.culling is None or self.culling.drop:
+                known.update(os.path.abspath(path) for path in self.culled)  # Dropped ones stay dropped
+            added = []
+            for path in file_paths:
+                if os.path.abspath(path) not in known:
+                    known.add(os.path.abspath(path))
+                    added.append(path)
+            self.file_paths.extend(added)
+            if self.cache_path is None and self.file_paths:
+                self.cache_path = sidecar_path(self.file_paths, "detections.sqlite")
+        return added
+
+    def analyze(self, progress=None, crop_box_interval=0.5):
+        """ Run detection over the frames that were not analyzed yet and extend the common crop box
+
+        `progress(done, total)` is called after every frame and may raise to stop the analysis,
+        the frames analyzed so far stay available. The provisional crop box is updated at most
+        every `crop_box_interval` seconds.
+        """
+        with self.condition:
+            self.analyzing = True
+            previous = self.infos[-1] if self.infos else None
+            start = len(self.infos)
+            file_paths = self.file_paths[start:]
+
+        try:
+            if file_paths and self.culling is not None:
+                file_paths = self._cull(start, file_paths)
+            if self.deflicker:
+                self._measure_luminance()
+
+            if not file_paths:
+                pass
+            elif self.stabilization == STABILIZATION_EYES:
+                if self.detector is None:
+                    self.detector = EyeDetector()
+
+                # The cache is opened here so analysis can run on any thread
+                cache = DetectionCache(self.cache_path, self.detector) if self.cache_path else None
+                try:
+                    infos = analyze(file_paths, self.detector, self.workers, cache, self.timer, previous)
+                    self._collect(infos, progress, crop_box_interval)
+                finally:
+                    if cache is not None:
+                        cache.close()
+            elif self.stabilization == STABILIZATION_HORIZON:
+                if self.horizon_detector is None:
+                    self.horizon_detector = HorizonDetector()
+                infos = analyze_horizon(file_paths, self.horizon_detector, self.workers, timer=self.timer,
+                                        previous=previous)
+                self._collect(infos, progress, crop_box_interval)
+            else:
+                with self.condition:
+                    self.infos.extend(FrameInfo(path, None, None, None, None) for path in file_paths)
+                if progress is not None:
+                    progress(len(self.infos), len(self.file_paths))
+        finally:
+            with self.condition:
+                self._update_crop_box()
+                self.analyzing = False
+                self.condition.notify_all()
+        return self
+
+    def _cull(self, start, file_paths):
+        """ Cull near-duplicate and blurry frames among the files from `start` on, returning the ones to analyze
+
+        The last frames before `start` were kept already, they are compared with so bursts and blur
+        are judged across the boundary. Signatures are kept next to the images unless caching is disabled.
+        """
+        with self.condition:
+            kept = self.file_paths[max(0, start - BLUR_WINDOW // 2):start]
+        index, index_path = self._frame_index()
+        culled = cull(kept + file_paths, self.culling, index, len(kept), self.workers, self.timer)[len(kept):]
+        if index_path:
+            index.save(index_path)
+
+        culled_paths = [path for path, is_culled in zip(file_paths, culled) if is_culled]
+        if not culled_paths or not self.culling.drop:
+            with self.condition:
+                self.culled.extend(culled_paths)
+            return file_paths
+        dropped = set(culled_paths)
+        with self.condition:
+            self.culled.extend(culled_paths)
+            # Files added in the meantime follow the ones to analyze
+            self.file_paths[start:] = [path for path in self.file_paths[start:] if path not in dropped]
+            if len(self.luminance) > start:
+                del self.luminance[start:]  # Measured before the drop, measured again from the index
+                self._update_gains()
+        return [path for path in file_paths if path not in dropped]
+
+    def _measure_luminance(self):
+        """ Measure the mean luminance of the files that have none yet and update the deflicker gains """
+        with self.condition:
+            file_paths = self.file_paths[len(self.luminance):]
+        if file_paths:
+            index, index_path = self._frame_index()
+            positions = index.update(file_paths, self.workers, self.timer)
+            if index_path:
+                index.save(index_path)
+            with self.condition:
+                self.luminance.extend(index.luminance[positions].tolist())
+        with self.condition:
+            self._update_gains()  # Also after the window changed
+
+    def _update_gains(self):
+        """ Smooth the measured luminance into per-frame gains, call with the condition held """
+        self.gains = deflicker_gains(self.luminance, self.deflicker) if self.deflicker and self.luminance else None
+
+    def _gain(self, index):
+        """ Deflicker gain of a frame, None if it is not deflickered; call with the condition held """
+        if not self.deflicker or self.gains is None or index >= len(self.gains):
+            return None
+        return float(self.gains[index])
+
+    @property
+    def crop_alignment(self):
+        """ Alignment of the crop box, the horizon is always levelled """
+        return ALIGN_SIMILARITY if self.stabilization == STABILIZATION_HORIZON else self.alignment
+
+    def _update_crop_box(self):
+        """ Extend the crop box by the frames analyzed since its last update, call with the condition held """
+        if self.stabilization in (STABILIZATION_EYES, STABILIZATION_HORIZON) and self.infos:
+            self.crop_box = extend_crop_box(self.crop_box, self.infos, self.crop_box_frames, self.crop_alignment)
+            self.crop_box_frames = len(self.infos)
+
+    def _collect(self, infos, progress, crop_box_interval):
+        """ Append analyzed frames as they arrive, keeping a provisional crop box up to date """
+        with closing(infos):
+            updated = 0.0
+            for info in infos:
+                with self.condition:
+                    self.infos.append(info)
+                    if time.perf_counter() - updated >= crop_box_interval:
+                        self._update_crop_box()
+                        updated = time.perf_counter()
+                    self.condition.notify_all()
+                if progress is not None:
+                    progress(len(self.infos), len(self.file_paths))
+
+    def save(self, path):
+        """ Write the file list, analysis and crop box to a JSON file, e.g. next to the other sidecar files """
+        directory = os.path.dirname(os.path.abspath(path))
+        with self.condition:
+            infos = list(self.infos)
+            state = {
+                "version": PROJECT_VERSION,
+                "stabilization": self.stabilization,
+                "alignment": self.alignment,
+                # Relative to the project file, so the project can be moved along with its images
+                "file_paths": [relative_path(file_path, directory) for file_path in self.file_paths],
+                "crop_box": self.crop_box,
+                "crop_box_frames": self.crop_box_frames,
+                "written": self.written,
+                "culled": [relative_path(file_path, directory) for file_path in self.culled],
+                "luminance": list(self.luminance),
+            }
+        # One list per field rather than one object per frame keeps large projects small and fast to parse
+        for field in FrameInfo._fields[1:]:
+            state[field] = [getattr(info, field) for info in infos]
+
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(json.dumps(state, separators=(",", ":")))  # dumps() uses the C encoder, dump() does not
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, stabilization=None, alignment=None, **options):
+        """ Restore a saved time-lapse, `options` are passed to the constructor
+
+        The analysis is kept unless `stabilization` or `alignment` differ from the saved ones.
+        """
+        with open(path) as f:
+            state = json.load(f)
+        if state.get("version") != PROJECT_VERSION:
+            raise ValueError(f"Unsupported project file: {path}")
+
+        directory = os.path.dirname(os.path.abspath(path))
+        file_paths = [os.path.normpath(os.path.join(directory, file_path)) for file_path in state["file_paths"]]
+        timelapse = cls(file_paths, stabilization or state["stabilization"], alignment=alignment or state["alignment"],
+                        **options)
+        timelapse.culled = [os.path.normpath(os.path.join(directory, file_path))
+                            for file_path in state.get("culled", [])]
+        timelapse.luminance = state.get("luminance", [])[:len(file_paths)]  # Independent of the stabilization
+        timelapse._update_gains()
+        if (timelapse.stabilization, timelapse.alignment) != (state["stabilization"], state["alignment"]):
+            return timelapse
+
+        timelapse.infos = [FrameInfo(file_path, tuple(shape) if shape else None,
+                                     tuple(eye_midpoint) if eye_midpoint else None, eye_angle, eye_distance)
+                           for file_path, shape, eye_midpoint, eye_angle, eye_distance
+                           in zip(file_paths, state["shape"], state["eye_midpoint"], state["eye_angle"],
+                                  state["eye_distance"])]
+        timelapse.crop_box = CropBox(*state["crop_box"]) if state["crop_box"] else None
+        timelapse.crop_box_frames = state["crop_box_frames"]
+        timelapse.written = state["written"]
+        return timelapse
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def _aligned_frames(self):
+        """ Yield (info, crop_box, gain) triples, waiting for frames that are still being analyzed """
+        i = 0
+        while True:
+            with self.condition:
+                while i >= len(self.infos) and self.analyzing:
+                    self.condition.wait()
+                if i >= len(self.infos):
+                    return
+                item = (self.infos[i], self.crop_box, self._gain(i))
+            yield item
+            i += 1
+
+    def _analyze_missing(self):
+        with self.condition:
+            needs_analysis = len(self.infos) < len(self.file_paths) and not self.analyzing
+        if needs_analysis:
+            self.analyze()
+
+    def frames(self, held=1):
+        """ Iterate over the rendered frames, of which the consumer may hold on to `held` at a time """
+        self._analyze_missing()
+        # The queue holds `window` frames and the producer one more
+        frames = render(self._aligned_frames(), self.max_size, self.window + 1 + held, self.timer)
+        return Prefetch(frames, self.window)
+
+    def render_frame(self, index, max_size=None):
+        """ Render a single analyzed frame with the current crop box, for random access e.g. by a player
+
+        `max_size` overrides the size of the time-lapse, e.g. to preview frames of a full-size export.
+        """
+        with self.condition:
+            item = (self.infos[index], self.crop_box, self._gain(index))
+        return next(render([item], max_size or self.max_size, buffers=1, timer=self.timer))
+
+    def write_frames(self, output_dir, pattern="frame_{:05d}.png"):
+        """ Write the frames as numbered image files, returning the number of files written
+
+        Frames written to the same files with the same crop box and size are kept, so after adding
+        files only the new frames are written, unless they changed the crop box. Deflickered frames
+        within half a window of the new ones are written again, their gains change with them.
+        """
+        self._analyze_missing()
+        with self.condition:
+            target = {"output_dir": os.path.abspath(output_dir), "pattern": pattern,
+                      "crop_box": list(self.crop_box) if self.crop_box else None,
+                      "max_size": list(self.max_size) if self.max_size else None, "deflicker": self.deflicker}
+            start = 0
+            if self.written and all(self.written.get(key) == value for key, value in target.items()):
+                start = min(self.written["count"], len(self.infos))
+                if start and not os.path.exists(os.path.join(output_dir, pattern.format(start - 1))):
+                    start = 0  # The frames were deleted since
+                if self.deflicker and start < len(self.infos):
+                    start = max(0, start - self.deflicker // 2)
+            items = [(info, self.crop_box, self._gain(i)) for i, info in enumerate(self.infos[start:], start)]
+
+        count = write_frames(render(items, self.max_size, timer=self.timer), output_dir, pattern, start)
+        self.written = dict(target, count=start + count)
+        return count
+
+    def __iter__(self):
+        return self.frames()
@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+
+
+def peak_offset(values, i):
+    """ Offset of the vertex of the parabola through values[i - 1:i + 2] from i, between -0.5 and 0.5 """
+    if not 0 < i < len(values) - 1:
+        return 0.0
+    before, peak, after = values[i - 1:i + 2]
+    curvature = before - 2 * peak + after
+    return 0.5 * (before - after) / curvature if curvature < 0 else 0.0
+
+
+class HorizonDetector:
+    """ Find the horizon of landscape frames as the strongest near-horizontal line
+
+    Frames are analyzed as small grayscale images. The strongest near-horizontal edge pixels of each
+    frame vote for the lines y = y0 + (x - centre) * tan(angle) through them, for every angle within
+    `max_angle` degrees. The votes of a whole batch are accumulated by a single bincount and the line
+    with the most edge strength wins per frame.
+    """
+    def __init__(self, size=480, max_angle=10.0, angle_step=0.25, edge_points=1500):
+        self.size = size  # Long side of the frames the horizon is searched on
+        self.max_angle = max_angle
+        self.angle_step = angle_step
+        self.edge_points = edge_points  # Strongest edge pixels of each frame that vote
+
+        self.angles = np.arange(-max_angle, max_angle + angle_step / 2, angle_step)
+        self.slopes = np.tan(np.radians(self.angles))
+
+    def edges(self, gray):
+        """ Return the (x, y, strength) of the strongest near-horizontal edge pixels of a frame """
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)
+        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+
+        # The gradient of a line tilted by a is tilted by a from the vertical, allow some slack for noise
+        strength = np.abs(gy)
+        strength[np.abs(gx) > strength * np.tan(np.radians(2 * self.max_angle))] = 0
+        strength[:2], strength[-2:], strength[:, :2], strength[:, -2:] = 0, 0, 0, 0  # Blur and Sobel borders
+
+        flat = strength.ravel()
+        count = min(self.edge_points, np.count_nonzero(flat))
+        strongest = np.argpartition(flat, flat.size - count)[flat.size - count:] if count else np.empty(0, np.int64)
+        y, x = np.divmod(strongest, gray.shape[1])
+        return x.astype(np.float32), y.astype(np.float32), flat[strongest]
+
+    def detect_batch(self, grays):
+        """ Return the (y0, angle) of the horizon of each frame, or None if a frame has no edges
+
+        y0 is the height of the horizon at the horizontal centre of the frame in its pixels, angle is
+        in degrees with positive values descending to the right.
+        """
+        bins, weights, offsets = [], [], [0]
+        for gray in grays:
+            height, width = gray.shape[:2]
+            x, y, strength = self.edges(gray)
+            # Height of the line through each edge pixel at the centre, for every angle
+            y0 = np.rint(y[None, :] - (x[None, :] - (width - 1) / 2) * self.slopes[:, None]).astype(np.int64)
+            valid = (y0 >= 0) & (y0 < height)
+            rows = np.broadcast_to(np.arange(len(self.angles))[:, None], y0.shape)
+            bins.append(offsets[-1] + rows[valid] * height + y0[valid])
+            weights.append(np.broadcast_to(strength[None, :], y0.shape)[valid])
+            offsets.append(offsets[-1] + len(self.angles) * height)
+
+        votes = np.bincount(np.concatenate(bins), np.concatenate(weights), minlength=offsets[-1]) if bins else []
+
+        results = []
+        for gray, start, stop in zip(grays, offsets, offsets[1:]):
+            accumulator = votes[start:stop].reshape(len(self.angles), gray.shape[0])
+            a, y0 = np.unravel_index(np.argmax(accumulator), accumulator.shape)
+            if accumulator[a, y0] <= 0:
+                results.append(None)
+                continue
+
+            # Refine height and angle between the bins with a parabola through the peak and its neighbours
+            angle = self.angles[a] + self.angle_step * peak_offset(accumulator[:, y0], a)
+            y0 = y0 + peak_offset(accumulator[a], y0)
+            results.append((float(y0), float(angle)))
+        return results
@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+
+
+class JobCancelled(Exception):
+    """ Raised inside a job's thread once the job has been cancelled """
+
+
+class Job:
+    """ A unit of background work created by JobScheduler.submit
+
+    The target receives the job and calls report() as it makes progress; report() raises
+    JobCancelled after cancel() so the work stops at the next frame.
+    """
+    def __init__(self, scheduler, name, target, on_progress=None, on_done=None, on_error=None):
+        self.scheduler = scheduler
+        self.name = name
+        self.target = target
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+
+        self.cancel_event = threading.Event()
+        self.finished = False
+        self.last_report = 0.0
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def report(self, done, total):
+        """ Post progress to the main thread, at most every `report_interval` seconds and on completion """
+        if self.cancelled:
+            raise JobCancelled(self.name)
+
+        now = time.perf_counter()
+        if self.on_progress is not None and (done == total or now - self.last_report >= self.scheduler.report_interval):
+            self.last_report = now
+            self.post(self.on_progress, self, done, total)
+
+    def post(self, callback, *args):
+        """ Call `callback(*args)` on the Tk main thread """
+        self.scheduler.events.put((callback, args))
+
+    def run(self):
+        try:
+            try:
+                result = self.target(self)
+            except JobCancelled:
+                result = None
+        except Exception as error:
+            if self.on_error is not None:
+                self.post(self.on_error, self, error)
+        else:
+            if self.on_done is not None:
+                self.post(self.on_done, self, result)
+        finally:
+            # Only after the final event is queued, the scheduler stops polling once all jobs finished
+            self.finished = True
+
+
+class JobScheduler:
+    """ Run jobs off the Tk main thread and deliver their events back through after()
+
+    Worker threads never touch widgets, they queue callbacks that the main thread polls every
+    `poll_interval` milliseconds while jobs are running.
+    """
+    def __init__(self, widget, poll_interval=50, report_interval=0.1):
+        self.widget = widget
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval  # Seconds between two progress events of a job
+        self.events = queue.Queue()
+        self.jobs = []
+        self.polling = False
+
+    def submit(self, name, target, on_progress=None, on_done=None, on_error=None):
+        """ Start `target(job)` on a background thread and return the Job """
+        job = Job(self, name, target, on_progress, on_done, on_error)
+        self.jobs.append(job)
+        threading.Thread(target=job.run, name=f"job-{name}", daemon=True).start()
+
+        if not self.polling:
+            self.polling = True
+            self.widget.after(self.poll_interval, self._poll)
+        return job
+
+    @property
+    def busy(self):
+        return any(not job.finished for job in self.jobs)
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def _poll(self):
+        # Collect finished jobs before draining, so their final events are delivered in this round
+        self.jobs = [job for job in self.jobs if not job.finished]
+        while True:
+            try:
+                callback, args = self.events.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+
+        if self.jobs or not self.events.empty():
+            self.widget.after(self.poll_interval, self._poll)
+        else:
+            self.polling = False
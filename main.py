@@ -2,7 +2,6 @@ import customtkinter as ctk
 from tkinterdnd2 import TkinterDnD
 from timelapse_frame import TimelapseFrame
 from settings_frame import SettingsFrame
-from preview_frame import PreviewFrame
 
 # Initialize custom tkinter
 ctk.set_appearance_mode("System")  # Can be "System", "Dark", or "Light"
@@ -29,10 +28,10 @@ class TimelapseApp(TkinterDnD.Tk):
         self.main_frame = ctk.CTkFrame(self, corner_radius=0)
         self.main_frame.pack(side="right", expand=True, fill="both")
 
-        # Initialize frames
+        # Initialize the first frame, the others are built when they are first shown
         self.timelapse_frame = TimelapseFrame(self.main_frame, self.show_preview_frame)
-        self.settings_frame = SettingsFrame(self.main_frame)
-        self.preview_frame = PreviewFrame(self.main_frame, self.show_timelapse_frame)
+        self.settings_frame = None
+        self.preview_frame = None
 
         # Show the Timelapse frame by default
         self.show_timelapse_frame()
@@ -45,11 +44,17 @@ class TimelapseApp(TkinterDnD.Tk):
     def show_settings_frame(self):
         # Clear the main frame and show the settings UI
         self.clear_frame()
+        if self.settings_frame is None:
+            self.settings_frame = SettingsFrame(self.main_frame)
         self.settings_frame.pack(expand=True, fill="both")
 
     def show_preview_frame(self, images):
         # Clear the main frame and show the preview UI with images
         self.clear_frame()
+        if self.preview_frame is None:
+            from preview_frame import PreviewFrame  # Deferred with the frame player until the first preview
+
+            self.preview_frame = PreviewFrame(self.main_frame, self.show_timelapse_frame)
         self.preview_frame.pack(expand=True, fill="both")
         self.preview_frame.start_preview(images)
 
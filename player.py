@@ -0,0 +1,263 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+from PIL import Image
+
+from common import PREVIEW_SIZE
+
+# Frame rates offered by the preview
+FPS_OPTIONS = [1, 5, 12, 24, 30]
+
+
+class FrameSource:
+    """ Random access to display-sized RGB frames of file paths, PIL images or a Timelapse
+
+    A Timelapse may still be analyzing, its frames become available as they are analyzed.
+    """
+    def __init__(self, items, size=PREVIEW_SIZE):
+        self.items = items
+        self.size = size
+
+    def __len__(self):
+        """ Number of frames that can be shown right now """
+        infos = getattr(self.items, "infos", None)
+        return len(infos) if infos is not None else len(self.items)
+
+    @property
+    def complete(self):
+        """ False while more frames are still to come """
+        return not getattr(self.items, "analyzing", False)
+
+    def key(self, index):
+        """ Cache key of a frame, aligned frames change with the (provisional) crop box """
+        return index, getattr(self.items, "crop_box", None)
+
+    def get(self, index):
+        if hasattr(self.items, "render_frame"):
+            frame = self.items.render_frame(index, self.size)  # Decoded no larger than needed
+            img = Image.fromarray(np.ascontiguousarray(frame[:, :, ::-1]))  # BGR to RGB
+        else:
+            item = self.items[index]
+            if isinstance(item, str):
+                img = Image.open(item)  # If it's a path, open the image
+                img.draft("RGB", self.size)  # Reduced JPEG decoding, the frame is shown small anyway
+            else:
+                img = item.copy()  # Otherwise, it's already an Image object
+            img = img.convert("RGB")
+        img.thumbnail(self.size, Image.LANCZOS)
+        return img
+
+
+class FramePlayer:
+    """ Play a FrameSource at a fixed frame rate
+
+    A background thread decodes frames ahead into a bounded ring buffer, so the Tk thread only
+    displays them. Playback follows the wall clock: frames that are due are shown, frames that are
+    already late are dropped instead of letting the timeline drift. Decoded frames are kept in a
+    bounded LRU cache for scrubbing back and forth.
+
+    `show_frame(index, image)` and `on_stats(achieved_fps, target_fps, dropped)` are called on the
+    Tk thread, the player schedules itself through `widget.after`.
+    """
+    def __init__(self, widget, source, show_frame, on_stats=None, fps=24, buffer_size=32, cache_size=128):
+        self.widget = widget
+        self.source = source
+        self.show_frame = show_frame
+        self.on_stats = on_stats
+        self.fps = fps
+        self.cache_size = cache_size
+
+        self.buffer = queue.Queue(maxsize=buffer_size)  # (generation, index, image), in index order
+        self.cache = OrderedDict()  # source key -> image, least recently used first
+        self.lock = threading.Lock()  # Guards generation, decode_index and cache
+        self.generation = 0  # Incremented on every seek, frames of older generations are discarded
+        self.decode_index = 0
+        self.starved = False  # The decoder waits for frames that are not analyzed yet
+        self.closed = False
+
+        self.playing = False
+        self.position = 0  # Index of the frame on screen
+        self.upcoming = None  # Frame taken from the buffer that is not due yet
+        self.start_index = 0
+        self.start_time = 0.0
+        self.dropped = 0
+        self.shown_times = deque(maxlen=64)
+
+        self.thread = threading.Thread(target=self._decode_frames, daemon=True)
+        self.thread.start()
+
+    # Decoder thread
+
+    def _target_index(self):
+        """ Index of the frame that is due according to the clock """
+        if not self.playing:
+            return 0
+        return self.start_index + int((time.perf_counter() - self.start_time) * self.fps)
+
+    def _frame(self, index):
+        key = self.source.key(index)
+        with self.lock:
+            image = self.cache.get(key)
+            if image is not None:
+                self.cache.move_to_end(key)
+                return image
+
+        image = self.source.get(index)
+        with self.lock:
+            self.cache[key] = image
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return image
+
+    def _decode_frames(self):
+        while not self.closed:
+            with self.lock:
+                generation, index = self.generation, self.decode_index
+
+            # Frames that are already late are not worth decoding, but the last one is always shown
+            available = len(self.source)
+            index = max(index, min(self._target_index(), available - 1))
+            if index >= available:
+                self.starved = not self.source.complete
+                time.sleep(0.02)
+                continue
+            self.starved = False
+
+            try:
+                image = self._frame(index)
+            except Exception:
+                image = None  # Unreadable file, shown as a gap
+            item = (generation, index, image)
+
+            while not self.closed and generation == self.generation:
+                try:
+                    self.buffer.put(item, timeout=0.05)
+                    break
+                except queue.Full:
+                    continue
+
+            with self.lock:
+                if generation == self.generation:
+                    self.decode_index = index + 1
+
+    # Tk thread
+
+    def play(self):
+        if self.playing:
+            return
+        if self.position >= len(self.source) - 1 and self.source.complete:
+            self.seek(0)  # Start over after the last frame
+        self.playing = True
+        self.start_index, self.start_time = self.position, time.perf_counter()
+        self.dropped = 0
+        self.shown_times.clear()
+        self._tick()
+
+    def pause(self):
+        self.playing = False
+
+    def set_fps(self, fps):
+        # Keep the current frame, only the speed from here on changes
+        self.fps = fps
+        self.start_index, self.start_time = self.position, time.perf_counter()
+
+    def seek(self, index):
+        """ Jump to a frame, e.g. while scrubbing; shows it right away if it is cached """
+        index = max(0, min(index, len(self.source) - 1))
+        with self.lock:
+            self.generation += 1
+            self.decode_index = index
+        self.upcoming = None
+        while True:
+            try:
+                self.buffer.get_nowait()
+            except queue.Empty:
+                break
+
+        self.position = index
+        self.start_index, self.start_time = index, time.perf_counter()
+        with self.lock:
+            image = self.cache.get(self.source.key(index))
+        if image is not None:
+            self.show_frame(index, image)
+        elif not self.playing:
+            self.widget.after(10, self._show_seeked, self.generation)
+
+    def _show_seeked(self, generation):
+        """ Show the frame scrubbed to while paused as soon as the decoder delivers it """
+        if generation != self.generation or self.playing or self.closed:
+            return  # Scrubbed further or playing again
+        while True:
+            try:
+                item = self.buffer.get_nowait()
+            except queue.Empty:
+                self.widget.after(10, self._show_seeked, generation)
+                return
+            if item[0] == generation:
+                break
+        self.upcoming = item  # Played first when resuming
+        if item[2] is not None:
+            self.show_frame(item[1], item[2])
+
+    def close(self):
+        self.playing = False
+        self.closed = True
+
+    def _tick(self):
+        if not self.playing or self.closed:
+            return
+
+        if not self.shown_times:
+            # The clock starts when the first frame is shown, not while it is still being decoded
+            self.start_time = time.perf_counter()
+        target = self._target_index()
+        due = None
+        while True:
+            if self.upcoming is None:
+                try:
+                    self.upcoming = self.buffer.get_nowait()
+                except queue.Empty:
+                    break
+            generation, index, image = self.upcoming
+            if generation != self.generation:
+                self.upcoming = None
+                continue
+            if index > target:
+                break  # Not due yet
+            due, self.upcoming = self.upcoming, None
+
+        if due is not None:
+            _, index, image = due
+            self.dropped += max(0, index - self.position - 1)  # Late frames that were skipped
+            self.position = index
+            if image is not None:
+                self.show_frame(index, image)
+            self.shown_times.append(time.perf_counter())
+            self.report_stats()
+        elif self.starved and self.buffer.empty():
+            # Waiting for frames that are still being analyzed, restart the clock from here
+            self.start_index, self.start_time = self.position + 1, time.perf_counter()
+
+        if self.position >= len(self.source) - 1 and self.source.complete and due is not None:
+            self.playing = False  # Stop after the last frame
+            return
+
+        # Wake up when the next frame is due
+        next_time = self.start_time + (self._target_index() + 1 - self.start_index) / self.fps
+        delay = max(1, int((next_time - time.perf_counter()) * 1000))
+        if due is None:
+            delay = min(delay, 10)  # Waiting for the decoder, show its frame as soon as it arrives
+        self.widget.after(delay, self._tick)
+
+    def achieved_fps(self):
+        if len(self.shown_times) < 2:
+            return 0.0
+        elapsed = self.shown_times[-1] - self.shown_times[0]
+        return (len(self.shown_times) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def report_stats(self):
+        if self.on_stats is not None:
+            self.on_stats(self.achieved_fps(), self.fps, self.dropped)
@@ -1,5 +1,7 @@
 import customtkinter as ctk
-from PIL import Image
+
+from common import PREVIEW_SIZE
+from player import FPS_OPTIONS, FramePlayer, FrameSource
 
 class PreviewFrame(ctk.CTkFrame):
     def __init__(self, parent, show_timelapse_callback):
@@ -10,12 +12,17 @@ class PreviewFrame(ctk.CTkFrame):
         self.image_label = ctk.CTkLabel(self, text="")
         self.image_label.pack(expand=True)
 
+        # Slider to scrub through the frames, also follows the playback
+        self.position_slider = ctk.CTkSlider(self, from_=0, to=1, number_of_steps=1, command=self.on_scrub)
+        self.position_slider.set(0)
+        self.position_slider.pack(fill="x", padx=20)
+
         # Create a frame to hold the buttons on the same row
         self.button_frame = ctk.CTkFrame(self)
         self.button_frame.pack(pady=20)
 
         # Back to Timelapse, Start, and Stop buttons aligned in the same frame
-        self.back_button = ctk.CTkButton(self.button_frame, text="Back to Timelapse", command=self.show_timelapse_callback)
+        self.back_button = ctk.CTkButton(self.button_frame, text="Back to Timelapse", command=self.go_back)
         self.back_button.pack(side="left", padx=10)
 
         self.start_button = ctk.CTkButton(self.button_frame, text="Start", command=self.start_preview)
@@ -24,75 +31,70 @@ class PreviewFrame(ctk.CTkFrame):
         self.stop_button = ctk.CTkButton(self.button_frame, text="Stop", command=self.stop_preview)
         self.stop_button.pack(side="left", padx=10)
 
+        # Playback speed and the frame rate actually achieved
+        self.fps_menu = ctk.CTkOptionMenu(self.button_frame, values=[f"{fps} fps" for fps in FPS_OPTIONS],
+                                          command=self.on_fps_change, width=90)
+        self.fps_menu.set("1 fps")
+        self.fps_menu.pack(side="left", padx=10)
+
+        self.fps_label = ctk.CTkLabel(self.button_frame, text="", width=160)
+        self.fps_label.pack(side="left", padx=10)
+
         self.images = []
+        self.player = None  # Decodes frames ahead on a background thread
         self.image_index = 0
-        self.is_previewing = False
+
+    @property
+    def is_previewing(self):
+        return self.player is not None and self.player.playing
 
     def start_preview(self, images=None):
-        """ Start the timelapse preview with a list of image file paths """
+        """ Start the timelapse preview with image file paths, images or a streaming time-lapse """
         if images:
-            self.images = images  # Only set new images if provided
-
-        if self.images and not self.is_previewing:
+            # Only set new images if provided, the player of the previous set stops decoding
+            self.images = images
+            if self.player is not None:
+                self.player.close()
+            self.player = FramePlayer(self, FrameSource(images, PREVIEW_SIZE), self.show_frame,
+                                      on_stats=self.show_stats, fps=self.selected_fps())
             self.image_index = 0
-            self.is_previewing = True
-            self.display_next_image()
+            self.position_slider.set(0)
+
+        if self.player is not None:
+            self.player.play()
 
     def stop_preview(self):
         """ Stop the timelapse preview """
-        self.is_previewing = False
-
-    def display_next_image(self):
-        if self.image_index < len(self.images) and self.is_previewing:
-            image = self.images[self.image_index]
-
-            # Check if it's a file path (string) or an image object
-            if isinstance(image, str):
-                img = Image.open(image)  # If it's a path, open the image
-            else:
-                img = image  # Otherwise, it's already an Image object
-
-            # Resize and display the image
-            img = self.resize_image_to_fit(img, (600, 400))
-
-            # Use CTkImage for high-DPI scaling and customtkinter compatibility
-            ctk_image = ctk.CTkImage(img, size=(img.width, img.height))
-
-            self.image_label.configure(image=ctk_image)
-            self.image_label.image = ctk_image  # Keep a reference to avoid garbage collection
-
-            self.image_index += 1
-
-            # Display the next image after 1 second (1000 ms)
-            self.after(1000, self.display_next_image)
-        else:
-            self.is_previewing = False  # Stop previewing after all images are displayed
-
-
-    def resize_image_to_fit(self, img, max_size):
-        """ Resize the image to fit within max_size, maintaining aspect ratio """
-        original_width, original_height = img.size
-        max_width, max_height = max_size
-
-        # Calculate the aspect ratio
-        aspect_ratio = original_width / original_height
-
-        # Determine new dimensions based on the aspect ratio
-        if original_width > original_height:
-            # Landscape orientation: fit width
-            new_width = min(original_width, max_width)
-            new_height = int(new_width / aspect_ratio)
-        else:
-            # Portrait orientation: fit height
-            new_height = min(original_height, max_height)
-            new_width = int(new_height * aspect_ratio)
-
-        # Ensure the image fits within the bounding box
-        if new_width > max_width:
-            new_width = max_width
-            new_height = int(new_width / aspect_ratio)
-        if new_height > max_height:
-            new_height = max_height
-            new_width = int(new_height * aspect_ratio)
-
-        return img.resize((new_width, new_height), Image.LANCZOS)
+        if self.player is not None:
+            self.player.pause()
+
+    def go_back(self):
+        self.stop_preview()
+        self.show_timelapse_callback()
+
+    def selected_fps(self):
+        return int(self.fps_menu.get().split()[0])
+
+    def on_fps_change(self, value):
+        if self.player is not None:
+            self.player.set_fps(self.selected_fps())
+
+    def on_scrub(self, value):
+        if self.player is not None:
+            self.player.seek(int(round(value)))
+
+    def show_frame(self, index, img):
+        # Use CTkImage for high-DPI scaling and customtkinter compatibility
+        ctk_image = ctk.CTkImage(img, size=(img.width, img.height))
+
+        self.image_label.configure(image=ctk_image)
+        self.image_label.image = ctk_image  # Keep a reference to avoid garbage collection
+        self.image_index = index
+
+        # Frames of a time-lapse that is still being aligned are added to the slider as they arrive
+        last = max(1, len(self.player.source) - 1)
+        self.position_slider.configure(to=last, number_of_steps=last)
+        self.position_slider.set(index)
+
+    def show_stats(self, achieved, target, dropped):
+        self.fps_label.configure(text=f"{achieved:.1f} / {target} fps, {dropped} dropped")
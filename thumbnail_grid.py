@@ -0,0 +1,184 @@
+import math
+import queue
+from collections import OrderedDict
+
+import customtkinter as ctk
+from PIL import ImageTk
+
+from common import THUMBNAIL_SIZE, sidecar_path
+from thumbnails import ThumbnailCache, ThumbnailLoader
+
+
+class ThumbnailGrid(ctk.CTkFrame):
+    """ Scrollable grid of image thumbnails that only materializes the visible rows
+
+    Thumbnails are generated on a thread pool and handed back to the Tk thread through after(),
+    so setting thousands of files returns immediately and only the visible cells cost any work.
+    """
+    def __init__(self, parent, thumbnail_size=THUMBNAIL_SIZE, padding=10, workers=4, max_cached=512,
+                 poll_interval=50):
+        super().__init__(parent)
+
+        self.thumbnail_size = thumbnail_size
+        self.cell_width = thumbnail_size[0] + 2 * padding
+        self.cell_height = thumbnail_size[1] + 2 * padding
+        self.workers = workers
+        self.max_cached = max_cached  # Thumbnails kept in memory for scrolling back
+        self.poll_interval = poll_interval
+
+        self.file_paths = []
+        self.columns = 1
+        self.loader = None
+        self.results = queue.Queue()  # (index, file_path, thumbnail) from the loader threads
+        self.thumbnails = OrderedDict()  # index -> PIL thumbnail, least recently shown first
+        self.items = {}  # index -> (canvas item, PhotoImage or None) of the visible cells
+        self.pending = {}  # index -> future of a requested thumbnail
+        self.failed = set()  # Indices of files that could not be read
+        self.polling = False
+
+        self.canvas = ctk.CTkCanvas(self, highlightthickness=0,
+                                    bg=self._apply_appearance_mode(self.cget("fg_color")))
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", expand=True, fill="both")
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+
+        self.canvas.bind("<Configure>", lambda event: self.layout())
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)  # Windows and macOS
+        self.canvas.bind("<Button-4>", lambda event: self.on_scroll("scroll", -1, "units"))  # Linux
+        self.canvas.bind("<Button-5>", lambda event: self.on_scroll("scroll", 1, "units"))
+
+    def set_files(self, file_paths):
+        """ Show the thumbnails of `file_paths`, replacing the previous set """
+        self.clear()
+        self.file_paths = list(file_paths)
+        if self.file_paths:
+            cache = ThumbnailCache(sidecar_path(self.file_paths, "thumbnails"), self.thumbnail_size)
+            self.loader = ThumbnailLoader(cache, self.workers)
+        self.canvas.yview_moveto(0)
+        self.layout()
+
+    def add_files(self, file_paths):
+        """ Append the thumbnails of `file_paths` after the current ones """
+        if not self.file_paths:
+            self.set_files(file_paths)
+            return
+        self.file_paths.extend(file_paths)
+        self.layout()
+
+    def clear(self):
+        for future in self.pending.values():
+            future.cancel()
+        if self.loader is not None:
+            self.loader.shutdown()
+            self.loader = None
+        self.canvas.delete("all")
+        self.pending.clear()
+        self.failed.clear()
+        self.items.clear()
+        self.thumbnails.clear()
+        self.results = queue.Queue()  # Drop results still on their way from the old loader
+
+    def on_scroll(self, *args):
+        self.canvas.yview(*args)
+        self.update_visible()
+
+    def on_mouse_wheel(self, event):
+        self.on_scroll("scroll", -1 if event.delta > 0 else 1, "units")
+
+    def layout(self):
+        """ Recompute the columns and the scroll region after a resize or a new set of files """
+        width = max(self.canvas.winfo_width(), self.cell_width)
+        columns = max(1, width // self.cell_width)
+        rows = math.ceil(len(self.file_paths) / columns)
+        self.canvas.configure(scrollregion=(0, 0, columns * self.cell_width, rows * self.cell_height),
+                              yscrollincrement=self.cell_height // 2)
+
+        if columns != self.columns:
+            # Every cell moves, recreate the visible ones at their new position
+            self.columns = columns
+            for item, _ in self.items.values():
+                self.canvas.delete(item)
+            self.items.clear()
+        self.update_visible()
+
+    def visible_range(self):
+        """ Indices of the cells in the visible rows, plus one row above and below """
+        top = self.canvas.canvasy(0)
+        bottom = top + max(self.canvas.winfo_height(), self.cell_height)
+        first_row = max(0, int(top // self.cell_height) - 1)
+        last_row = int(bottom // self.cell_height) + 1
+        return range(first_row * self.columns, min(len(self.file_paths), (last_row + 1) * self.columns))
+
+    def update_visible(self):
+        visible = self.visible_range()
+
+        # Recycle the cells that scrolled out of view and stop loading their thumbnails
+        for index in [index for index in self.items if index not in visible]:
+            self.canvas.delete(self.items.pop(index)[0])
+        for index in [index for index in self.pending if index not in visible]:
+            self.pending.pop(index).cancel()  # A thumbnail that is already loading is kept for scrolling back
+
+        for index in visible:
+            if index not in self.items:
+                self.show_cell(index)
+
+    def cell_center(self, index):
+        row, column = divmod(index, self.columns)
+        return (column * self.cell_width + self.cell_width // 2, row * self.cell_height + self.cell_height // 2)
+
+    def show_cell(self, index):
+        x, y = self.cell_center(index)
+        thumbnail = self.thumbnails.get(index)
+        if index in self.failed:
+            self.items[index] = (self.canvas.create_text(x, y, text="?", fill="gray50"), None)
+        elif thumbnail is None:
+            # Placeholder until the thumbnail arrives
+            width, height = self.thumbnail_size
+            item = self.canvas.create_rectangle(x - width // 2, y - height // 2, x + width // 2, y + height // 2,
+                                                outline="gray50")
+            self.items[index] = (item, None)
+            self.request(index)
+        else:
+            self.thumbnails.move_to_end(index)
+            photo = ImageTk.PhotoImage(thumbnail)
+            self.items[index] = (self.canvas.create_image(x, y, image=photo), photo)
+
+    def request(self, index):
+        if index in self.pending or self.loader is None:
+            return
+        results = self.results
+        file_path = self.file_paths[index]
+        self.pending[index] = self.loader.submit(
+            file_path, lambda path, thumbnail: results.put((index, path, thumbnail)))
+
+        if not self.polling:
+            self.polling = True
+            self.after(self.poll_interval, self.poll)
+
+    def poll(self):
+        """ Move finished thumbnails from the loader threads into the grid """
+        while True:
+            try:
+                index, file_path, thumbnail = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.pop(index, None)
+            if index >= len(self.file_paths) or self.file_paths[index] != file_path:
+                continue  # From a previous set of files
+
+            if thumbnail is None:
+                self.failed.add(index)
+            else:
+                self.thumbnails[index] = thumbnail
+                while len(self.thumbnails) > self.max_cached:
+                    self.thumbnails.popitem(last=False)
+
+            if index in self.items:
+                self.canvas.delete(self.items.pop(index)[0])
+                self.show_cell(index)
+
+        if self.pending:
+            self.after(self.poll_interval, self.poll)
+        else:
+            self.polling = False
@@ -0,0 +1,96 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from common import THUMBNAIL_SIZE
+
+
+def embedded_thumbnail(img, size):
+    """ Return the EXIF thumbnail of a JPEG if it is large enough and has the image's aspect ratio """
+    get_child_images = getattr(img, "get_child_images", None)  # Pillow >= 9.5
+    if get_child_images is None:
+        return None
+    try:
+        children = get_child_images()
+    except Exception:
+        return None  # A broken EXIF block is no reason to fail, the draft path still works
+
+    for child in children:
+        # Reject letterboxed thumbnails, e.g. 160x120 stored for a 3:2 photo
+        same_aspect = abs(child.width / child.height - img.width / img.height) < 0.02
+        if same_aspect and child.width >= min(size[0], img.width) and child.height >= min(size[1], img.height):
+            child.load()
+            return child
+    return None
+
+
+def make_thumbnail(file_path, size=THUMBNAIL_SIZE):
+    """ Create a thumbnail through the cheapest decode path available
+
+    JPEGs use their embedded EXIF thumbnail if it is usable, otherwise draft mode lets libjpeg
+    decode at 1/2, 1/4 or 1/8 scale instead of full resolution.
+    """
+    with Image.open(file_path) as img:
+        thumbnail = embedded_thumbnail(img, size)
+        if thumbnail is None:
+            img.draft("RGB", size)  # No-op for formats without scaled decoding
+            thumbnail = img.convert("RGB") if img.mode not in ("RGB", "L") else img.copy()
+        thumbnail.thumbnail(size)
+        return thumbnail
+
+
+class ThumbnailCache:
+    """ On-disk cache of thumbnails as small JPEG files, keyed by path, size and modification time """
+    def __init__(self, directory, size=THUMBNAIL_SIZE):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def cache_path(self, file_path):
+        stat = os.stat(file_path)
+        key = f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}:{self.size[0]}x{self.size[1]}"
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".jpg")
+
+    def get(self, file_path):
+        """ Return the thumbnail of a file, generating and storing it if it is not cached yet """
+        cache_path = self.cache_path(file_path)
+        try:
+            with Image.open(cache_path) as img:
+                img.load()
+                return img
+        except (OSError, ValueError):
+            pass
+
+        thumbnail = make_thumbnail(file_path, self.size)
+        # Write to a temporary file first, a concurrent reader never sees half a thumbnail
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        thumbnail.convert("RGB").save(temp_path, "JPEG", quality=85)
+        os.replace(temp_path, cache_path)
+        return thumbnail
+
+
+class ThumbnailLoader:
+    """ Generate thumbnails on a thread pool
+
+    `callback(file_path, thumbnail)` is called on a worker thread, with None as thumbnail if the
+    file could not be read.
+    """
+    def __init__(self, cache, workers=4):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, file_path, callback):
+        """ Queue a thumbnail, the returned future can be cancelled while it has not started """
+        return self.executor.submit(self._load, file_path, callback)
+
+    def _load(self, file_path, callback):
+        try:
+            thumbnail = self.cache.get(file_path)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            thumbnail = None
+        callback(file_path, thumbnail)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
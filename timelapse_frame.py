@@ -1,10 +1,18 @@
 import customtkinter as ctk
-from tkinter import messagebox
+from tkinter import filedialog, messagebox
 from tkinterdnd2 import DND_FILES
-from PIL import Image, ImageTk
 import os
-import cv2  # OpenCV for face and eye detection
-import numpy as np
+
+from common import (STABILIZATION_OPTIONS, PREVIEW_START_FRAMES, DEFAULT_DUPLICATE_DISTANCE, DEFAULT_BLUR_RATIO,
+                    DEFAULT_DEFLICKER_WINDOW, sidecar_path)
+from jobs import JobScheduler
+
+# The engine and encoder pull in OpenCV, the engine's detector loads its cascades on first use. They are
+# imported on first use so the window opens without waiting for them. NumPy and PIL are not avoided this
+# way: customtkinter already imports PIL, and Pillow 10 imports NumPy with it.
+
+# Number of file names listed in the dialog after a drop
+MAX_LISTED_FILES = 20
 
 class TimelapseFrame(ctk.CTkFrame):
     def __init__(self, parent, show_preview_callback):
@@ -12,15 +20,17 @@ class TimelapseFrame(ctk.CTkFrame):
 
         self.show_preview_callback = show_preview_callback  # Reference to switch to Preview Frame
 
-        # Load the OpenCV face and eye classifiers
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        self.eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+        # Created with the first project and reused for every one after it, its classifiers load on first use
+        self.eye_detector = None
 
-        # Store the uploaded file paths and thumbnails
-        self.uploaded_files = []
-        self.thumbnail_size = (100, 100)
+        # The project holds the uploaded files with their analysis and is saved next to the images
+        self.project = None
+        self.project_path = None
         self.image_frame = None
-        self.aligned_images = []  # Store in-memory aligned images
+
+        # Alignment and export run off the Tk main thread
+        self.scheduler = JobScheduler(self)
+        self.preview_started = False
 
         # Create a container for drag-and-drop and images
         self.content_frame = ctk.CTkFrame(self)
@@ -38,162 +48,221 @@ class TimelapseFrame(ctk.CTkFrame):
         self.stabilization_label = ctk.CTkLabel(self, text="Select Stabilization Mode:")
         self.stabilization_label.pack(side="bottom", pady=10)
 
-        self.stabilization_options = ["None", "Eye Tracking", "Horizon"]
+        self.stabilization_options = STABILIZATION_OPTIONS
         self.stabilization_combobox = ctk.CTkComboBox(self, values=self.stabilization_options)
         self.stabilization_combobox.pack(side="bottom", pady=10)
 
+        # Near-duplicates and blurry frames are cheap to find, they are skipped before detection
+        self.cull_checkbox = ctk.CTkCheckBox(self, text="Skip near-duplicate and blurry frames")
+        self.cull_checkbox.pack(side="bottom", pady=10)
+
+        # Brightness is evened out while rendering, from luminance measured on small decodes
+        self.deflicker_checkbox = ctk.CTkCheckBox(self, text="Deflicker")
+        self.deflicker_checkbox.pack(side="bottom", pady=10)
+
         # Add a Preview button (initially hidden until images are uploaded)
         self.preview_button = ctk.CTkButton(self, text="Preview", command=self.show_preview)
         self.preview_button.pack(side="bottom", pady=20)
         self.preview_button.pack_forget()  # Hide until images are uploaded
 
+        # Add the export controls (initially hidden until images are uploaded)
+        self.export_frame = ctk.CTkFrame(self)
+        self.display_time_label = ctk.CTkLabel(self.export_frame, text="Display time (s):")
+        self.display_time_label.pack(side="left", padx=10)
+        self.display_time_entry = ctk.CTkEntry(self.export_frame, width=60)
+        self.display_time_entry.insert(0, "1.0")
+        self.display_time_entry.pack(side="left", padx=10)
+        self.export_button = ctk.CTkButton(self.export_frame, text="Export Video", command=self.export_video)
+        self.export_button.pack(side="left", padx=10)
+
+        # Progress of background jobs with their stage timings (hidden until a job runs)
+        self.progress_frame = ctk.CTkFrame(self)
+        self.progress_bar = ctk.CTkProgressBar(self.progress_frame)
+        self.progress_bar.pack(side="top", fill="x", padx=10, pady=5)
+        self.status_label = ctk.CTkLabel(self.progress_frame, text="")
+        self.status_label.pack(side="top", padx=10)
+        self.cancel_button = ctk.CTkButton(self.progress_frame, text="Cancel", command=self.scheduler.cancel_all)
+        self.cancel_button.pack(side="left", padx=10, pady=5)
+        self.timings_button = ctk.CTkButton(self.progress_frame, text="Save Timings", command=self.save_timings)
+        self.timings_button.pack(side="left", padx=10, pady=5)
+
+    @property
+    def uploaded_files(self):
+        return self.project.file_paths if self.project is not None else []
+
     def on_file_drop(self, event):
-        """ Handle the dropped files """
+        """ Handle the dropped files, they are appended to the project """
         file_paths = self.split_filenames(event.data)
-        file_names = [os.path.basename(path) for path in file_paths]  # Extract just the filenames
-
-        self.uploaded_files = file_paths  # Store the full paths for later preview
-        self.display_uploaded_images(file_paths)  # Display thumbnails
-
-        messagebox.showinfo("Files Dropped", "\n".join(file_names))
-
-        # Show the preview button after images are uploaded
+        if not file_paths:
+            return
+
+        if self.project is None:
+            self.open_project(file_paths)
+            self.display_uploaded_images(self.project.file_paths)  # Display thumbnails
+        added = self.project.add_files(file_paths)  # Only the new files are analyzed again
+        if self.image_frame is not None and added:
+            self.image_frame.add_files(added)
+        file_names = [os.path.basename(path) for path in added]  # Extract just the filenames
+
+        # List a limited number of names, the dialog has to stay usable for thousands of files
+        listed = file_names[:MAX_LISTED_FILES]
+        if len(file_names) > len(listed):
+            listed.append(f"... and {len(file_names) - len(listed)} more")
+        if not listed:
+            listed = ["All files are already part of the time-lapse."]
+        messagebox.showinfo("Files Dropped", "\n".join(listed))
+
+        # Show the preview and export controls after images are uploaded
         self.preview_button.pack(side="bottom")
+        self.export_frame.pack(side="bottom", pady=10)
+
+    def open_project(self, file_paths):
+        """ Continue the project saved next to the images, or start a new one """
+        from engine import EyeDetector, Timelapse
+
+        self.eye_detector = self.eye_detector or EyeDetector()
+        self.project_path = sidecar_path(file_paths, "project.json")
+        if os.path.exists(self.project_path):
+            try:
+                self.project = Timelapse.load(self.project_path, detector=self.eye_detector)
+                self.stabilization_combobox.set(self.project.stabilization)
+                return
+            except (OSError, ValueError, KeyError) as error:
+                messagebox.showwarning("Project Not Loaded", f"Starting a new project: {error}")
+        self.project = Timelapse([], self.stabilization_combobox.get(), detector=self.eye_detector)
+
+    def current_project(self):
+        """ Return the project for the selected stabilization mode """
+        from culling import CullSettings
+        from engine import Timelapse
+
+        selected_stabilization = self.stabilization_combobox.get()  # Get the selected stabilization mode
+        if self.project.stabilization != selected_stabilization:
+            # Another mode starts the analysis over, eye detections still come from the detection cache
+            culled, luminance = self.project.culled, self.project.luminance
+            self.project = Timelapse(self.project.file_paths, selected_stabilization, detector=self.eye_detector)
+            self.project.culled, self.project.luminance = culled, luminance
+        # Culling applies to the frames that are analyzed next, frames analyzed before stay
+        self.project.culling = (CullSettings(DEFAULT_DUPLICATE_DISTANCE, DEFAULT_BLUR_RATIO, drop=True)
+                                if self.cull_checkbox.get() else None)
+        self.project.deflicker = DEFAULT_DEFLICKER_WINDOW if self.deflicker_checkbox.get() else None
+        return self.project
+
+    def analyze_project(self, project, job):
+        """ Analyze the frames added since the last job, saving what was analyzed even if cancelled """
+        try:
+            project.analyze(progress=job.report)
+        finally:
+            project.save(self.project_path)
 
     def display_uploaded_images(self, file_paths):
         """ Replace the drag-and-drop area with thumbnails of the uploaded images """
         # Remove the drag-and-drop area
         self.drop_area.pack_forget()
 
-        # Create a frame to hold the thumbnails
-        if self.image_frame:
-            self.image_frame.destroy()  # Remove the previous image frame if it exists
-
-        self.image_frame = ctk.CTkFrame(self.content_frame)
-        self.image_frame.pack(pady=20, expand=True, fill="both")
-
-        # Add the thumbnails of the uploaded images
-        for i, file_path in enumerate(file_paths):
-            img = Image.open(file_path)
-            img.thumbnail(self.thumbnail_size)  # Create thumbnail with the specified size
-            img_tk = ImageTk.PhotoImage(img)
-
-            label = ctk.CTkLabel(self.image_frame, image=img_tk, text="")
-            label.image = img_tk  # Keep a reference to avoid garbage collection
-            label.grid(row=i // 4, column=i % 4, padx=10, pady=10)  # Arrange in a grid (4 columns)
-
-    def align_images_based_on_eyes(self, file_paths):
-        """ Align images based on eye detection and crop them to ensure all images have the same relative eye alignment """
-        aligned_images = []
-        eye_positions = []
-        image_shapes = []
-
-        # Initialize crop limits with extreme values for the minimal crop
-        min_left_distance = float('inf')
-        min_right_distance = float('inf')
-        min_top_distance = float('inf')
-        min_bottom_distance = float('inf')
-
-        for file_path in file_paths:
-            # Load image in grayscale for eye detection
-            img = cv2.imread(file_path)
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-            # Detect faces in the image
-            faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
-            if len(faces) == 0:
-                # Convert to PIL Image and append unaligned image
-                aligned_images.append(Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)))
-                image_shapes.append(img.shape)  # Store image shape for cropping
-                continue  # Skip alignment if no face is detected
-
-            for (x, y, w, h) in faces:
-                roi_gray = gray[y:y+h, x:x+w]
-
-                # Detect eyes within the face region
-                eyes = self.eye_cascade.detectMultiScale(roi_gray)
-                if len(eyes) >= 2:  # We need at least two eyes to align
-                    # Calculate the center of the eyes
-                    eye1, eye2 = eyes[0], eyes[1]
-                    eye1_center = (x + eye1[0] + eye1[2] // 2, y + eye1[1] + eye1[3] // 2)
-                    eye2_center = (x + eye2[0] + eye2[2] // 2, y + eye2[1] + eye2[3] // 2)
-
-                    # Calculate midpoint of the two eyes
-                    eye_midpoint = ((eye1_center[0] + eye2_center[0]) // 2, (eye1_center[1] + eye2_center[1]) // 2)
-                    eye_positions.append(eye_midpoint)
-
-                    # Convert to PIL Image and append unaligned image
-                    aligned_images.append(Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)))
-                    image_shapes.append(img.shape)  # Store image shape for cropping
-
-                    # Calculate the distances to each edge of the image
-                    img_height, img_width = img.shape[:2]
-
-                    left_distance = eye_midpoint[0]  # Distance to the left edge
-                    right_distance = img_width - eye_midpoint[0]  # Distance to the right edge
-                    top_distance = eye_midpoint[1]  # Distance to the top edge
-                    bottom_distance = img_height - eye_midpoint[1]  # Distance to the bottom edge
-
-                    # Update the minimal distances for cropping
-                    min_left_distance = min(min_left_distance, left_distance)
-                    min_right_distance = min(min_right_distance, right_distance)
-                    min_top_distance = min(min_top_distance, top_distance)
-                    min_bottom_distance = min(min_bottom_distance, bottom_distance)
-
-        # Determine the final crop box dimensions based on the minimal distances
-        crop_width = min_left_distance + min_right_distance
-        crop_height = min_top_distance + min_bottom_distance
-
-        # Apply cropping to all aligned images based on the calculated crop limits
-        cropped_images = []
-        for i, pil_img in enumerate(aligned_images):
-            # Get image dimensions
-            img_width, img_height = pil_img.size
-
-            # Calculate crop box based on the eye midpoint and minimal distances
-            eye_midpoint = eye_positions[i]
-
-            left = eye_midpoint[0] - min_left_distance
-            top = eye_midpoint[1] - min_top_distance
-            right = left + crop_width
-            bottom = top + crop_height
-
-            # Ensure we don't crop outside image boundaries
-            left = max(0, left)
-            top = max(0, top)
-            right = min(img_width, right)
-            bottom = min(img_height, bottom)
-
-            # Crop the image based on the calculated box
-            cropped_img = pil_img.crop((left, top, right, bottom))
-            cropped_images.append(cropped_img)
-
-        return cropped_images
-
-    def shift_image(self, img, dx, dy):
-        """ Shift an image by dx and dy """
-        rows, cols, _ = img.shape
-        M = np.float32([[1, 0, dx], [0, 1, dy]])
-        shifted_img = cv2.warpAffine(img, M, (cols, rows))
-        return shifted_img
+        # Create the thumbnail grid once, it only materializes the visible rows
+        if self.image_frame is None:
+            from thumbnail_grid import ThumbnailGrid
+
+            self.image_frame = ThumbnailGrid(self.content_frame)
+            self.image_frame.pack(pady=20, expand=True, fill="both")
+
+        # Thumbnails are generated in the background and cached next to the images
+        self.image_frame.set_files(file_paths)
 
     def show_preview(self):
-        """ Switch to the preview frame if images are uploaded """
+        """ Align the images in the background and switch to the preview once the first frames are ready """
         if not self.uploaded_files:
             messagebox.showwarning("No Images", "Please upload images before previewing.")
+        elif self.scheduler.busy:
+            messagebox.showwarning("Busy", "Please wait for the running job to finish or cancel it.")
         else:
-            selected_stabilization = self.stabilization_combobox.get()  # Get the selected stabilization mode
-
-            # If Eye Tracking is selected, align the images in-memory
-            if selected_stabilization == "Eye Tracking":
-                self.aligned_images = self.align_images_based_on_eyes(self.uploaded_files)
-                print(f"Eye Tracking stabilization applied, showing aligned images.")
-                self.show_preview_callback(self.aligned_images)  # Pass in-memory aligned images to the preview
-
-            # If no stabilization is selected, show the original images
-            else:
-                print(f"Stabilization: {selected_stabilization}, showing original images.")
-                self.show_preview_callback(self.uploaded_files)  # Pass original images for preview
+            # The engine aligns the new images, frames are decoded and warped to the preview size on demand
+            project = self.current_project()
+            self.preview_started = False
+            self.start_job("Aligning", lambda job: self.analyze_project(project, job), self.on_alignment_done)
+
+    def export_video(self):
+        """ Align the images at full resolution and encode them into an MP4 in the background """
+        if not self.uploaded_files:
+            messagebox.showwarning("No Images", "Please upload images before exporting.")
+            return
+        if self.scheduler.busy:
+            messagebox.showwarning("Busy", "Please wait for the running job to finish or cancel it.")
+            return
+
+        try:
+            display_time = float(self.display_time_entry.get())
+            if display_time <= 0:
+                raise ValueError(display_time)
+        except ValueError:
+            messagebox.showerror("Invalid Display Time", "Please enter the display time in seconds, e.g. 0.5")
+            return
+
+        output_path = filedialog.asksaveasfilename(defaultextension=".mp4", filetypes=[("MP4 Video", "*.mp4")])
+        if not output_path:
+            return
+
+        from encoder import write_video
+
+        project = self.current_project()
+
+        def export(job):
+            self.analyze_project(project, job)
+            return write_video(project, output_path, display_time, progress=job.report)
+
+        self.start_job("Exporting", export, self.on_export_done)
+
+    def start_job(self, name, target, on_done):
+        """ Run a job on the scheduler and show its progress """
+        self.progress_bar.set(0)
+        self.status_label.configure(text=f"{name}...")
+        self.cancel_button.configure(state="normal")
+        self.progress_frame.pack(side="bottom", fill="x", padx=20, pady=10)
+        self.scheduler.submit(name, target, on_progress=self.on_job_progress, on_done=on_done,
+                              on_error=self.on_job_error)
+
+    def on_job_progress(self, job, done, total):
+        self.progress_bar.set(done / total if total else 1.0)
+        self.status_label.configure(text=f"{job.name} {done}/{total}: {self.project.timer.format()}")
+        if self.image_frame is not None and len(self.image_frame.file_paths) != total:
+            self.image_frame.set_files(self.project.file_paths)  # Culled frames were dropped
+
+        # Start the preview on the first aligned frames while the rest are still processing
+        if job.name == "Aligning" and not self.preview_started and done >= PREVIEW_START_FRAMES:
+            self.start_preview_playback()
+
+    def on_alignment_done(self, job, result):
+        if not self.preview_started and self.project.infos:
+            self.start_preview_playback()
+        self.finish_job(job)
+
+    def on_export_done(self, job, stats):
+        self.finish_job(job)
+        if stats is not None:
+            messagebox.showinfo("Export Finished", f"Encoded {stats['frames']} frames at {stats['fps']:.1f} fps.")
+
+    def on_job_error(self, job, error):
+        self.finish_job(job)
+        messagebox.showerror(f"{job.name} Failed", str(error))
+
+    def finish_job(self, job):
+        state = "Cancelled" if job.cancelled else "Finished"
+        culled = f", {len(self.project.culled)} near-duplicate or blurry frames skipped" if self.project.culled else ""
+        self.status_label.configure(text=f"{job.name} {state.lower()}: {self.project.timer.format()}{culled}")
+        self.cancel_button.configure(state="disabled")
+
+    def start_preview_playback(self):
+        self.preview_started = True
+        self.show_preview_callback(self.project)
+
+    def save_timings(self):
+        """ Dump the stage timings of the last job to a JSON file """
+        if self.project is None:
+            return
+        output_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
+        if output_path:
+            self.project.timer.dump(output_path)
 
     @staticmethod
     def split_filenames(filenames):
@@ -0,0 +1,50 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """ Accumulate wall-clock time and call counts per pipeline stage, safe to share between threads """
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the body of a with-block as one call of stage `name` """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, count=1):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def totals(self):
+        """ Return {stage: (seconds, count)}, e.g. to hand timings back from a worker process """
+        with self.lock:
+            return {name: (self.seconds[name], self.counts[name]) for name in self.seconds}
+
+    def merge(self, totals):
+        """ Add the totals of another timer """
+        for name, (seconds, count) in totals.items():
+            self.add(name, seconds, count)
+
+    def summary(self):
+        """ Return {stage: {"seconds", "count", "mean_ms"}} for every recorded stage """
+        return {name: {"seconds": seconds, "count": count, "mean_ms": 1000 * seconds / count if count else 0.0}
+                for name, (seconds, count) in self.totals().items()}
+
+    def format(self):
+        """ One-line description of the mean time per call of each stage """
+        return ", ".join(f"{name} {stats['mean_ms']:.1f} ms" for name, stats in self.summary().items())
+
+    def dump(self, path):
+        """ Write the summary to a JSON file """
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)